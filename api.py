@@ -1,15 +1,23 @@
 from utils import *
 
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload, MediaFileUpload
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+# The rest of the client libraries take a while to import, so they're imported where 
+# they're first used instead, which is after the filesystem has been mounted
+from googleapiclient.errors import HttpError
+from transport import *
+from scheduler import *
+from metrics import *
 
 import pickle
+import json
 import os.path
 import re
 import shutil
-import io
+import tempfile
+import threading
+import time
+import mimetypes
+import functools
+import collections
 
 CLIENT_SECRET_FILE = 'credentials.json'
 SCOPES = ['https://www.googleapis.com/auth/drive']
@@ -26,20 +34,90 @@ ATIME = 'viewedByMeTime'
 MTIME = 'modifiedTime'
 PARENTS = 'parents'
 TRASHED = 'trashed'
-FIELD_LIST = [ID, NAME, MTYPE, MTIME, PARENTS, ATIME, MTIME, PARENTS, TRASHED]
+SIZE = 'size'
+MD5 = 'md5Checksum'
+HEAD_REVISION = 'headRevisionId'
+FIELD_LIST = [ID, NAME, MTYPE, MTIME, PARENTS, ATIME, MTIME, PARENTS, TRASHED, SIZE, MD5, HEAD_REVISION]
 FIELDS = ', '.join(FIELD_LIST)
 
+DOWNLOAD_CHUNK_SIZE = 10*(1 << 20) # bytes held in memory at once while downloading
+# Files larger than this are uploaded in chunks of this size with resumable uploads.
+# It has to be a multiple of 256 KiB.
+UPLOAD_CHUNK_SIZE = 8*(1 << 20)
+PAGE_SIZE = 1000 # maximum number of results per files.list page
+BATCH_SIZE = 100 # maximum number of requests sent in one batch request
+DENTRY_TTL = 30 # seconds that name lookups (including misses) are cached for
+DENTRY_CACHE_SIZE = 10000 # maximum number of name lookups cached at once
+
+def timed(method):
+    # Records the latency of a DriveAPI method
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.metrics.observe('api_call_seconds', time.perf_counter()-start, method=method.__name__)
+    return wrapper
+
 class DriveAPI():
-    def __init__(self):
+    def __init__(self, chunk_size=DOWNLOAD_CHUNK_SIZE, dentry_ttl=DENTRY_TTL, upload_chunk_size=UPLOAD_CHUNK_SIZE,
+                 transport='pooled', pool_size=POOL_SIZE, endpoint=None, rate_limit=RATE_LIMIT):
+        # 'transport' is the name of one of the TRANSPORTS, or a class like them.
+        # 'endpoint' is the root URL of another server implementing the Drive API 
+        # (like a fake one for testing), which is used without authentication.
         dbg('Creating API instance.')
         self.creds = None
         self.types = None
+        self.chunk_size = chunk_size
+        self.upload_chunk_size = upload_chunk_size
+        # Caches the results of name lookups as (parent ID, name) -> (item or None, expiry time),
+        # in the order they expire in
+        self.dentries = collections.OrderedDict()
+        self.dentry_ttl = dentry_ttl
+        self.dentry_lock = threading.Lock()
 
         self._init_config()
-        self._init_creds()
+        if endpoint is None:
+            self._init_creds()
+        else:
+            from google.auth.credentials import AnonymousCredentials
+            self.creds = AnonymousCredentials()
+
+        # The service object is shared, but every request is executed on an HTTP object 
+        # from the transport, which makes all methods safe to call concurrently.
+        if isinstance(transport, str):
+            transport = TRANSPORTS[transport]
+        self.transport = transport(self.creds, pool_size)
+        self.metrics = Metrics()
+        # Every request goes through the scheduler, which keeps them within the quota
+        self.scheduler = RequestScheduler(rate_limit, metrics=self.metrics)
 
+        # The service is built when it's first needed
+        self.endpoint = endpoint
+        self.service_lock = threading.Lock()
+        self._service = None
+
+    @property
+    def service(self):
+        if self._service is None:
+            with self.service_lock:
+                if self._service is None:
+                    self._service = self._build_service()
+        return self._service
+
+    def _build_service(self):
+        # Build the service from the discovery document bundled with the client library,
+        # instead of fetching it from Google
         dbg('Building service.')
-        self.service = build('drive', 'v3', credentials=self.creds)
+        from googleapiclient.discovery import build_from_document
+        from googleapiclient.discovery_cache import get_static_doc
+        doc = json.loads(get_static_doc('drive', 'v3'))
+        if self.endpoint is not None:
+            dbg('Using the Drive API at "{}"', self.endpoint)
+            # all request URLs (including uploads and batches) are relative to the root URL
+            doc['rootUrl'] = self.endpoint
+        return build_from_document(doc, credentials=self.creds)
 
     def _init_creds(self):
         # This file stores the user's access and refresh tokens, 
@@ -47,23 +125,23 @@ class DriveAPI():
         dbg('Loading access credentials.')
         token_path = os.path.join(CONFIG_DIR, 'token.pkl')
         if os.path.exists(token_path):
-            dbg('Attempting to load saved creds from {}.'.format(token_path))
+            dbg('Attempting to load saved creds from {}.', token_path)
             with open(token_path, 'rb') as token:
                 self.creds = pickle.load(token)
+        if self.creds and self.creds.expired and self.creds.refresh_token:
+            # Refreshing takes a request, so it's left to the first request made with them
+            dbg('Creds have expired, and will be refreshed when they are first used.')
         # If no valid creds exist, let the user log in.
-        if not self.creds or not self.creds.valid:
-            if self.creds and self.creds.expired and self.creds.refresh_token:
-                dbg('Creds had expired. Refreshing.')
-                self.creds.refresh(Request())
-            else:
-                dbg('Prompting user for permission.')
-                if not os.path.exists(CLIENT_SECRET_FILE):
-                    err('No OAuth credentials found! Expected a "{}" file. \
-                         Since this project is not registered as an official project, \
-                         you have to create your own OAuth client at \
-                         https://console.developers.google.com/apis/credentials/oauthclient'.format(CLIENT_SECRET_FILE))
-                flow = InstalledAppFlow.from_client_secrets_file(CLIENT_SECRET_FILE, SCOPES)
-                self.creds = flow.run_local_server(port=0)
+        elif not self.creds or not self.creds.valid:
+            dbg('Prompting user for permission.')
+            if not os.path.exists(CLIENT_SECRET_FILE):
+                err('No OAuth credentials found! Expected a "{}" file. \
+                     Since this project is not registered as an official project, \
+                     you have to create your own OAuth client at \
+                     https://console.developers.google.com/apis/credentials/oauthclient'.format(CLIENT_SECRET_FILE))
+            from google_auth_oauthlib.flow import InstalledAppFlow
+            flow = InstalledAppFlow.from_client_secrets_file(CLIENT_SECRET_FILE, SCOPES)
+            self.creds = flow.run_local_server(port=0)
             # Save the creds for the next run
             dbg('Saving credentials for next time.')
             with open(token_path, 'wb') as token:
@@ -80,52 +158,167 @@ class DriveAPI():
         with open(CONFIG_TYPE_PATH, 'r') as f:
             contents = f.read()
             self.types = eval(contents)
-            dbg('Loaded config: '+str(self.types))
+            dbg('Loaded config: {}', self.types)
 
-    def exec_query(self, query):
-        dbg('Executing query "{}".'.format(query))
-        results = self.service.files().list(
+    def _http(self):
+        # Returns the authorized HTTP object for the calling thread to make requests on
+        return self.transport.http()
+
+    def _execute(self, request):
+        # Execute a request once the scheduler lets it through
+        return self.scheduler.call(lambda: request.execute(http=self._http()))
+
+    @timed
+    def list_page(self, query, page_token=None, page_size=PAGE_SIZE):
+        # Returns one page of query results, and the token for the next page (or None).
+        dbg('Executing query "{}" (page token {}).', query, page_token)
+        results = self._execute(self.service.files().list(
             q=query,
             spaces='drive',
             corpora='user',
-            fields='files({})'.format(FIELDS)
-        ).execute()
-        return results.get('files', [])
+            pageSize=page_size,
+            pageToken=page_token,
+            fields='nextPageToken, files({})'.format(FIELDS)
+        ))
+        return results.get('files', []), results.get('nextPageToken')
+
+    def iter_query(self, query, page_size=PAGE_SIZE):
+        # Yields query results as each page arrives
+        page_token = None
+        while True:
+            items, page_token = self.list_page(query, page_token, page_size)
+            for item in items:
+                yield item
+            if page_token is None:
+                break
+
+    def exec_query(self, query):
+        return list(self.iter_query(query))
+
+    @timed
+    def get_start_page_token(self):
+        # Returns the token marking the current position in the changes feed
+        dbg('Getting start page token for the changes feed')
+        results = self._execute(self.service.changes().getStartPageToken())
+        return results['startPageToken']
+
+    @timed
+    def list_changes(self, page_token):
+        # Returns all changes since 'page_token', and the token to continue from next time.
+        dbg('Listing changes since page token {}', page_token)
+        changes = []
+        while True:
+            results = self._execute(self.service.changes().list(
+                pageToken=page_token,
+                spaces='drive',
+                pageSize=PAGE_SIZE,
+                includeRemoved=True,
+                fields='nextPageToken, newStartPageToken, changes(fileId, removed, file({}))'.format(FIELDS)
+            ))
+            changes.extend(results.get('changes', []))
+            if 'newStartPageToken' in results:
+                return changes, results['newStartPageToken']
+            page_token = results['nextPageToken']
 
+    @timed
     def get_file(self, fid):
-        dbg('Finding file by ID {}'.format(fid))
-        results = self.service.files().get(
+        dbg('Finding file by ID {}', fid)
+        results = self._execute(self.service.files().get(
             fileId=fid,
             fields=FIELDS,
-        ).execute()
+        ))
         return results
 
-    def traverse_path(self, path):
-        dbg('Traversing path "{}".'.format(path))
-        # TODO cache the results of this lookup somewhere
+    @timed
+    def get_files(self, fids):
+        # Returns a dict of file ID -> item (or None if there's no such file) for 'fids',
+        # fetched with batch requests
+        items = dict()
+        def fetch(fids):
+            # Each request in a batch counts against the quota, and can be throttled 
+            # on its own, in which case the ones that weren't are kept and the rest retried
+            throttled = []
+            def callback(request_id, response, exception):
+                if exception is not None:
+                    if is_throttled(exception):
+                        throttled.append(exception)
+                        return
+                    if not isinstance(exception, HttpError) or exception.resp.status != 404:
+                        raise exception
+                    response = None
+                items[request_id] = response
+            dbg('Finding {} files by ID in a batch', len(fids))
+            batch = self.service.new_batch_http_request(callback=callback)
+            for fid in fids:
+                batch.add(self.service.files().get(fileId=fid, fields=FIELDS), request_id=fid)
+            batch.execute(http=self._http())
+            if len(throttled) != 0:
+                raise throttled[0]
+        fids = list(fids)
+        for i in range(0, len(fids), BATCH_SIZE):
+            batch_fids = fids[i:i+BATCH_SIZE]
+            self.scheduler.call(lambda: fetch([fid for fid in batch_fids if not fid in items]), 
+                                cost=len(batch_fids))
+        return items
+
+    @timed
+    def lookup(self, parent_id, fname):
+        # Returns the file named 'fname' in the folder 'parent_id', or None if there's no such file.
+        # Results are cached for a while, so repeated lookups of missing files stay local.
+        key = (parent_id, fname)
+        with self.dentry_lock:
+            entry = self.dentries.get(key)
+        if entry is not None and entry[1] > time.time():
+            self.metrics.count('cache_hits', cache='lookup')
+            return entry[0]
+        self.metrics.count('cache_misses', cache='lookup')
+        escaped = fname.replace('\\', '\\\\').replace("'", "\\'")
+        query = "name = '{0}' and '{1}' in parents".format(escaped, parent_id)
+        items, _ = self.list_page(query, page_size=2)
+        item = None
+        if not items:
+            dbg('File "{}" not found!', fname)
+        elif len(items) != 1:
+            dbg('Multiple files with the name "{}" were found!', fname)
+        else:
+            item = items[0]
+        with self.dentry_lock:
+            now = time.time()
+            # (re)insert at the end, and drop the expired lookups (and the oldest ones 
+            # past the limit) from the start, so misses don't pile up
+            self.dentries[key] = (item, now+self.dentry_ttl)
+            self.dentries.move_to_end(key)
+            while len(self.dentries) > DENTRY_CACHE_SIZE or \
+                    (len(self.dentries) != 0 and next(iter(self.dentries.values()))[1] <= now):
+                self.dentries.popitem(last=False)
+        return item
+
+    def forget(self, parent_id, fname):
+        # Drop a cached name lookup, after the file was created, moved or removed
+        with self.dentry_lock:
+            self.dentries.pop((parent_id, fname), None)
+
+    def traverse_path(self, path, root_id='root'):
+        dbg('Traversing path "{}".', path)
         hierarchy = re.split(r'/+', path)
         last_item = None
-        parent_id = 'root'
+        parent_id = root_id
         for fname in hierarchy:
             if not fname:
                 # handle any empty filenames resulting from extra slashes
                 continue
             # look for the current file in the current parent
-            items = self.exec_query("name = '{0}' and '{1}' in parents".format(fname, parent_id))
-            if not items:
-                dbg('File "{}" not found!'.format(fname))
-                return None
-            elif len(items) != 1:
-                dbg('Multiple files with the name "{}" were found!'.format(fname))
+            item = self.lookup(parent_id, fname)
+            if item is None:
                 return None
             # remember the file we found
-            item = items[0]
             parent_id = item['id']
             last_item = item
         return last_item
 
+    @timed
     def download(self, node, local_path, cache=True):
-        dbg('Downloading file "{}" to local path "{}".'.format(str(node), local_path))
+        dbg('Downloading file "{}" to local path "{}".', node, local_path)
         if cache and os.path.exists(local_path):
             return
         file_id = node[ID]
@@ -142,32 +335,58 @@ class DriveAPI():
         else:
             # otherwise, this is just a generic file
             request = self.service.files().get_media(fileId=file_id)
-        # download the file
-        fh = io.BytesIO()
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
-        while done is False:
-            status, done = downloader.next_chunk()
-            #dbg("Download {}%.".format(int(status.progress()*100)))
-        # write the data to a file
-        with open(local_path, "wb") as f:
-            f.write(fh.getbuffer())
+        request.http = self._http()
+        from googleapiclient.http import MediaIoBaseDownload
+        # stream the file to a temporary file next to the destination, 
+        # and move it into place once it's complete
+        fd, tmp_path = tempfile.mkstemp(prefix='.', suffix='.part', dir=os.path.dirname(local_path))
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                downloader = MediaIoBaseDownload(fh, request, chunksize=self.chunk_size)
+                done = False
+                while done is False:
+                    status, done = self.scheduler.call(downloader.next_chunk)
+                    #dbg("Download {}%.".format(int(status.progress()*100)))
+            os.replace(tmp_path, local_path)
+            self.metrics.count('bytes_downloaded', os.path.getsize(local_path))
+        except:
+            os.remove(tmp_path)
+            raise
 
-    def delete(self, fid):
-        dbg('Deleting file with ID "{}"'.format(fid))
-        self.service.files().delete(fileId=fid).execute()
+    @timed
+    def download_range(self, fid, start, end, revision=None):
+        # Download the bytes [start, end) of a (non-Workspace) file with an HTTP Range request.
+        # If 'revision' is given, they're taken from that revision instead of the latest one.
+        dbg('Downloading bytes {}-{} of file ID "{}"', start, end, fid)
+        if revision is None:
+            request = self.service.files().get_media(fileId=fid)
+        else:
+            request = self.service.revisions().get_media(fileId=fid, revisionId=revision)
+        request.headers['Range'] = 'bytes={}-{}'.format(start, end-1)
+        data = self._execute(request)
+        self.metrics.count('bytes_downloaded', len(data))
+        return data
 
-    def update(self, fid, body):
-        dbg('Updating file with ID "{}" and body "{}"'.format(fid, body))
-        return self.service.files().update(fileId=fid, body=body, fields=FIELDS).execute()
+    @timed
+    def delete(self, fid):
+        dbg('Deleting file with ID "{}"', fid)
+        self._execute(self.service.files().delete(fileId=fid))
 
-    def change_parent(self, fid, old_parent, new_parent):
-        dbg('Changing parent for file with ID "{}", old parent "{}", and new parent "{}"'.format(fid, old_parent, new_parent))
-        return self.service.files().update(fileId=fid, addParents=new_parent, 
-                    removeParents=old_parent, fields=FIELDS).execute()
+    @timed
+    def update(self, fid, body=None, old_parent=None, new_parent=None):
+        # Updates the metadata in 'body' and moves the file from 'old_parent' to 'new_parent' 
+        # (if given), all in a single request
+        dbg('Updating file with ID "{}" and body "{}"', fid, body)
+        kwargs = dict()
+        if new_parent is not None and new_parent != old_parent:
+            dbg('Changing parent for file with ID "{}", old parent "{}", and new parent "{}"', fid, old_parent, new_parent)
+            kwargs = dict(addParents=new_parent, removeParents=old_parent)
+        return self._execute(self.service.files().update(fileId=fid, body=body or dict(), fields=FIELDS, 
+                    **kwargs))
 
+    @timed
     def create(self, name, parent, is_dir, in_trash):
-        dbg('Creating new file "{}" with parent "{}"'.format(name, parent))
+        dbg('Creating new file "{}" with parent "{}"', name, parent)
         # Register a new file with the remote, without uploading any data
         file_metadata = {
             NAME: name,
@@ -175,16 +394,78 @@ class DriveAPI():
         }
         if is_dir:
             file_metadata[MTYPE] = FOLDER_MTYPE
-        item = self.service.files().create(body=file_metadata, fields=FIELDS).execute()
         if in_trash:
-            body = {TRASHED: True}
-            item = self.trash(item[ID], body)
+            # (created straight in the trash)
+            file_metadata[TRASHED] = True
+        item = self._execute(self.service.files().create(body=file_metadata, fields=FIELDS))
+        self.forget(parent, name)
         return item
 
-    def upload(self, lpath, fid):
-        dbg('Uploading local path "{}" for file ID "{}"'.format(lpath, fid))
-        media = MediaFileUpload(lpath)
-        return self.service.files().update(fileId=fid, media_body=media, fields=FIELDS).execute()
+    @timed
+    def upload(self, fh, fid, session=None, progress=None):
+        # Upload the contents of the open (binary) file 'fh' as the new contents of file ID 'fid'.
+        # Large files are sent in chunks over a resumable upload session, which can be 
+        # continued from where it left off by passing its URI as 'session'.
+        # 'progress' is called with (session URI, bytes uploaded, total bytes) after every chunk.
+        dbg('Uploading local path "{}" for file ID "{}"', fh.name, fid)
+        from googleapiclient.http import MediaIoBaseUpload
+        mimetype = mimetypes.guess_type(fh.name)[0] or 'application/octet-stream'
+        size = os.fstat(fh.fileno()).st_size
+        if size <= self.upload_chunk_size:
+            media = MediaIoBaseUpload(fh, mimetype=mimetype)
+            item = self._execute(self.service.files().update(fileId=fid, media_body=media, fields=FIELDS))
+            self.metrics.count('bytes_uploaded', size)
+            return item
+        media = MediaIoBaseUpload(fh, mimetype=mimetype, chunksize=self.upload_chunk_size, resumable=True)
+        request = self.service.files().update(fileId=fid, media_body=media, fields=FIELDS)
+        if session is not None:
+            dbg('Resuming upload session "{}"', session)
+            try:
+                offset = self._upload_offset(session, size)
+            except HttpError as e:
+                if e.resp.status in (404, 410):
+                    dbg('Upload session "{}" expired', session)
+                    return self.upload(fh, fid, progress=progress)
+                raise
+            if offset is None:
+                # the last chunk made it, only its response didn't
+                return self.get_file(fid)
+            # the upload continues from there (the chunks are read from 'fh' by offset)
+            request.resumable_uri = session
+            request.resumable_progress = offset
+        response = None
+        while response is None:
+            sent = request.resumable_progress
+            try:
+                # a chunk that's throttled is retried after asking the server what it got
+                status, response = self.scheduler.call(lambda: request.next_chunk(http=self._http()))
+            except HttpError as e:
+                if session is not None and e.resp.status in (404, 410):
+                    # the session expired, so start over
+                    dbg('Upload session "{}" expired', session)
+                    fh.seek(0)
+                    return self.upload(fh, fid, progress=progress)
+                raise
+            session = request.resumable_uri
+            self.metrics.count('bytes_uploaded', (size if response is not None else request.resumable_progress)-sent)
+            if status is not None and progress is not None:
+                progress(session, status.resumable_progress, status.total_size)
+        return response
+
+    def _upload_offset(self, session, size):
+        # Ask the server how many bytes of the resumable upload session of a 'size' bytes 
+        # file it has received, or None if it has all of them
+        headers = {'Content-Length': '0', 'Content-Range': 'bytes */{}'.format(size)}
+        def query():
+            resp, content = self._http().request(session, 'PUT', headers=headers)
+            if resp.status in (200, 201):
+                return None
+            if resp.status != 308:
+                raise HttpError(resp, content, uri=session)
+            # (there's no range if it hasn't received anything yet)
+            received = resp.get('range')
+            return int(received.split('-')[1])+1 if received is not None else 0
+        return self.scheduler.call(query)
 
 def main():
     api = DriveAPI()
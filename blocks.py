@@ -0,0 +1,68 @@
+from utils import *
+
+BLOCK_SIZE = 1 << 20 # size of the chunks fetched with ranged reads (1 MiB)
+READAHEAD_MAX = 8 # maximum number of blocks read ahead of a sequential reader
+
+class BlockMap():
+    # Keeps track of which fixed-size blocks of a sparse local copy have been fetched
+    def __init__(self, size, block_size=BLOCK_SIZE):
+        self.size = size
+        self.block_size = block_size
+        self.nblocks = (size+block_size-1)//block_size
+        self.bitmap = bytearray((self.nblocks+7)//8)
+        self.present = 0
+        # read-ahead state
+        self.next_offset = 0
+        self.window = 0
+
+    def has(self, block):
+        return self.bitmap[block//8] & (1 << (block%8)) != 0
+
+    def add(self, block):
+        if not self.has(block):
+            self.bitmap[block//8] |= 1 << (block%8)
+            self.present += 1
+
+    def restore(self, bitmap):
+        # Restores the present blocks from a bitmap saved in a previous session
+        self.bitmap = bytearray(bitmap)
+        self.present = sum(bin(byte).count('1') for byte in self.bitmap)
+
+    def complete(self):
+        return self.present == self.nblocks
+
+    def readahead(self, offset, length):
+        # Returns how many bytes to read past the end of this request.
+        # The window grows while the reader stays sequential, and resets otherwise.
+        if offset == self.next_offset and offset != 0:
+            self.window = min(max(2*self.window, 1), READAHEAD_MAX)
+        else:
+            self.window = 0
+        self.next_offset = offset+length
+        return self.window*self.block_size
+
+    def missing(self, start, end):
+        # Returns the byte ranges (start, end) of missing blocks overlapping [start, end),
+        # with adjacent missing blocks merged into a single range
+        end = min(end, self.size)
+        if start >= end:
+            return []
+        runs = []
+        first = start//self.block_size
+        last = (end-1)//self.block_size
+        run_start = None
+        for block in range(first, last+1):
+            if not self.has(block):
+                if run_start is None:
+                    run_start = block
+            elif run_start is not None:
+                runs.append((run_start, block))
+                run_start = None
+        if run_start is not None:
+            runs.append((run_start, last+1))
+        return [(b*self.block_size, min(e*self.block_size, self.size)) for b, e in runs]
+
+    def fill(self, start, end):
+        # Marks the blocks covered by the byte range [start, end) as present
+        for block in range(start//self.block_size, (end+self.block_size-1)//self.block_size):
+            self.add(block)
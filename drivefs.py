@@ -1,31 +1,191 @@
 #!/usr/bin/env python3
 from utils import *
 from api import *
+from blocks import *
+from index import *
+from paths import *
+from uploads import *
+from quota import *
+from prefetch import *
+from exports import *
 
 from fuse import FUSE, FuseOSError, Operations
 
 import os
-import sys
 import errno
 import shutil
+import argparse
+import threading
+import fcntl
+import time
+import hashlib
+import stat
+import itertools
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+CRAWL_WORKERS = 8 # number of folders listed concurrently while building the cache
+POLL_INTERVAL = 5 # seconds between polls of the Drive changes feed
+SAVE_INTERVAL = 60 # seconds between snapshots of the metadata index
+COPY_BUFSIZE = 1 << 20 # bytes read at once while snapshotting files for upload
+# Seconds that the kernel caches attributes and directory entries for. Without the changes 
+# feed, this is also how long directory listings are served locally before they're re-listed.
+ATTR_TIMEOUT = 5
+ENTRY_TIMEOUT = 5
+# Modes of files and directories, since Drive doesn't have any
+FILE_MODE = stat.S_IFREG | 0o644
+DIR_MODE = stat.S_IFDIR | 0o755
+DIR_SIZE = 4096
+# Operations on file contents, which take the locks they need themselves 
+# so that slow transfers don't hold up unrelated operations
+CONTENT_OPS = ('open', 'read', 'write', 'truncate', 'flush', 'release', 'fsync')
+# Operations that change the hierarchy on the remote (or look it up), which also take 
+# the locks they need themselves, so that they don't hold up unrelated operations while 
+# waiting for the remote
+METADATA_OPS = ('create', 'mknod', 'mkdir', 'unlink', 'rmdir', 'rename', 'access')
+# Operations that aren't run with the lock held (destroy waits for background uploads, 
+# which need the lock to finish)
+UNLOCKED_OPS = CONTENT_OPS+METADATA_OPS+('destroy',)
+# Operations that change the metadata kept in the index (besides remote changes and uploads)
+INDEXED_OPS = ('create', 'mknod', 'mkdir', 'unlink', 'rmdir', 'rename')
+# Virtual read-only files exposing the metrics of the mount, in JSON and Prometheus formats.
+# Their contents are generated when they're opened, so they report a size that's 
+# large enough for any contents, and reads stop short at the actual end.
+CONTROL_DIR = '/.drivefs'
+CONTROL_FILES = {
+    'stats': lambda metrics: metrics.to_json(),
+    'stats.prom': lambda metrics: metrics.to_prometheus(),
+}
+CONTROL_SIZE = 1 << 24
 
 class DriveFS(Operations):
-    def __init__(self):
+    def __init__(self, lazy=True, chunk_size=DOWNLOAD_CHUNK_SIZE, crawl_workers=CRAWL_WORKERS, 
+                 poll_interval=POLL_INTERVAL, fresh=False, dentry_ttl=DENTRY_TTL, 
+                 upload_workers=UPLOAD_WORKERS, upload_chunk_size=UPLOAD_CHUNK_SIZE,
+                 cache_dir=CONFIG_DIR, cache_size=0, cache_files=0, attr_timeout=ATTR_TIMEOUT,
+                 transport='pooled', pool_size=POOL_SIZE, endpoint=None, rate_limit=RATE_LIMIT,
+                 prefetch_workers=PREFETCH_WORKERS, prefetch_size=PREFETCH_SIZE, prefetch_files=PREFETCH_FILES,
+                 stats_dump=None, export_cache_size=EXPORT_CACHE_SIZE):
         dbg('Intializing API')
-        self.api = DriveAPI()
-        self.tmp_dir = '/tmp/drivefs'
+        self.api = DriveAPI(chunk_size=chunk_size, dentry_ttl=dentry_ttl, upload_chunk_size=upload_chunk_size,
+                            transport=transport, pool_size=pool_size, endpoint=endpoint, rate_limit=rate_limit)
+        # The local copies and the metadata index are kept between mounts.
+        # Everything is kept on the same filesystem, so files can be moved between these.
+        self.tmp_dir = os.path.join(cache_dir, 'cache')
+        self.reuse_dir = os.path.join(cache_dir, 'reuse')
+        self.download_dir = os.path.join(cache_dir, 'downloads')
+        self.upload_dir = os.path.join(cache_dir, 'uploads')
+        self.pending_dir = os.path.join(cache_dir, 'pending')
+        self.export_dir = os.path.join(cache_dir, 'exports')
         self.trash_dir = '/.Trash'
-        self.root_name = 'My Drive'
-        self.root_id = self.api.get_file('root')[ID]
+        self.root_id = None # looked up when the mount starts
+        # In lazy mode only metadata is fetched at mount time, 
+        # and file contents are downloaded the first time they are opened
+        self.lazy = lazy
+        self.crawl_workers = crawl_workers
+        # Contents that are likely to be read soon are fetched ahead of time in lazy mode:
+        # up to 'prefetch_files' files of up to 'prefetch_size' bytes from directories 
+        # being scanned, and the blocks after what sequential readers have read so far
+        self.prefetch_size = prefetch_size
+        self.prefetch_files = prefetch_files
+        self.prefetcher = Prefetcher(self.api.scheduler.in_background(self._fetch), 
+                                     self.api.scheduler.in_background(self._fetch_range),
+                                     workers=prefetch_workers if lazy else 0)
+        # Remote changes are picked up by polling the changes feed in the background.
+        # If this is disabled (0), directories are re-listed on every readdir instead.
+        self.poll_interval = poll_interval
+        self.tracker = None
+        self.stop_tracking = threading.Event()
+        # Otherwise, directories listed more than 'attr_timeout' seconds ago are still served 
+        # from the cache, but get re-listed in the background
+        self.attr_timeout = attr_timeout
+        self.listed_at = dict() # maps directory IDs to when they were last listed
+        self.revalidating = set()
+        self.revalidator = ThreadPoolExecutor(max_workers=1)
+        # Protects the cached metadata below. Operations on file contents are 
+        # serialized per file by the locks in file_locks, and only take this lock 
+        # briefly, since they have to be able to run without it while transferring data.
+        self.lock = threading.RLock()
+        self.file_locks = dict()
+        # Local changes are pushed to the remote in the background.
+        # Requests made by background threads wait for the ones filesystem operations are waiting on.
+        self.uploads = UploadQueue(self.api.scheduler.in_background(self._upload), workers=upload_workers)
+        # The metadata in the index is only usable together with the changes feed, 
+        # since that's what brings it up to date on the next mount. The uploads
+        # recorded in it are picked up by the next mount either way.
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.index = MetadataIndex(os.path.join(cache_dir, 'index.db'))
+        self.index_dirty = False
+        # The local copies of file contents are limited to 'cache_size' bytes and 'cache_files'
+        # files (if not 0), by turning the least recently used ones back into placeholders
+        self.cache_size = cache_size
+        self.cache_files = cache_files
+        # Everything belongs to the user who mounted the drive
+        self.uid = os.getuid()
+        self.gid = os.getgid()
+        # Operations and API calls are timed, and the rest is counted as it happens
+        # (or read when the metrics are). The metrics are written to 'stats_dump' 
+        # (as Prometheus text if it ends with .prom, or JSON) when unmounting.
+        self.metrics = self.api.metrics
+        self.op_seconds = dict() # maps operations to the histograms of their latencies
+        self.metrics.gauge('upload_queue', lambda: len(self.uploads))
+        self.metrics.gauge('upload_bytes_sent', lambda: self.uploads.sent()[0])
+        self.metrics.gauge('upload_bytes_total', lambda: self.uploads.sent()[1])
+        self.metrics.gauge('prefetch_queue', lambda: len(self.prefetcher))
+        self.metrics.gauge('cache_bytes', lambda: self.quota.total)
+        self.metrics.gauge('cache_files', lambda: len(self.quota))
+        self.metrics.gauge('export_cache_bytes', lambda: self.exports.quota.total)
+        self.metrics.gauge('open_files', lambda: len(self.open_files))
+        self.metrics.gauge('items', lambda: len(self.id_to_item))
+        self.stats_dump = stats_dump
+        self.control_handles = dict() # maps handles of open control files to their contents
+        # Open files and directories are identified by their handles from then on, rather 
+        # than by their paths (which may change meanwhile), so these map them to file IDs
+        self.handles = dict()
+        self.dir_handles = dict()
+        self.dir_handle_ids = itertools.count(1)
 
-        # These dicts cache local state, and need to be updated for relevant operations
-        self.path_to_id = {self.trash_dir: 'root'} # TODO: deal with duplicate paths
-        self.id_to_item = dict()
-        self.id_to_children = dict()
+        # Everything that needs the remote (looking up the root, and loading the index or 
+        # crawling the drive) happens in the background once mounted (see _start), so the
+        # mount shows up right away. Operations wait until that's done, and fail if it failed.
+        self.fresh = fresh
+        self.started = threading.Event()
+        self.start_error = None
+        self.mounted_at = time.time()
 
         # Initialize the local FS
         self._init_tmp()
-        self._build_cache()
+        self._init_uploads()
+        # Exports of Workspace documents are kept between mounts (and evictions) 
+        # as well, up to 'export_cache_size' bytes of them
+        self.exports = ExportCache(self.export_dir, export_cache_size)
+
+    def __call__(self, op, *args):
+        start = time.perf_counter()
+        try:
+            if len(args) != 0 and (args[0] == CONTROL_DIR or args[0].startswith(CONTROL_DIR+'/')):
+                return self._control(op, *args)
+            if op != 'init' and not self.started.is_set():
+                self.started.wait()
+            if self.start_error is not None and not op in ('init', 'destroy'):
+                raise FuseOSError(errno.EIO)
+            if op in INDEXED_OPS:
+                self.index_dirty = True
+            if op in UNLOCKED_OPS:
+                return super().__call__(op, *args)
+            with self.lock:
+                return super().__call__(op, *args)
+        except OSError as e:
+            self.metrics.count('fuse_errors', op=op, errno=errno.errorcode.get(e.errno, e.errno))
+            raise
+        finally:
+            elapsed = time.perf_counter()-start
+            histogram = self.op_seconds.get(op)
+            if histogram is None:
+                histogram = self.op_seconds[op] = self.metrics.histogram('fuse_op_seconds', op=op)
+            histogram.observe(elapsed)
+            dbg('{} took {:.3f} ms', op, elapsed*1000)
 
     ''' Helper methods '''
 
@@ -33,314 +193,1199 @@ class DriveFS(Operations):
         # Returns whether a given remote path is in the trash directory
         return rpath[:len(self.trash_dir)] == self.trash_dir
 
+    def _start(self):
+        # Build the local state, and start keeping it in sync with the remote
+        try:
+            self.root_id = self.api.get_file('root')[ID]
+            # These cache local state, and need to be updated for relevant operations
+            self._clear_state()
+            # local changes the last mount didn't get to upload survive rebuilding the cache
+            self._set_aside_pending()
+            if self.poll_interval and not self.fresh and self._load_index():
+                dbg('Loaded metadata index from the last mount')
+            else:
+                self._reset_tmp()
+                if self.poll_interval:
+                    # grab the token before crawling, so no changes are missed
+                    self.changes_token = self.api.get_start_page_token()
+                self._build_cache()
+                self._restore_pending()
+                self.index_dirty = True
+            dbg('Loaded the drive in {:.3f} s', time.time()-self.mounted_at)
+            self.mounted_at = time.time()
+            self._evict()
+            if self.poll_interval:
+                self.tracker = threading.Thread(target=self.api.scheduler.in_background(self._track_changes), 
+                                                daemon=True)
+                self.tracker.start()
+            for fid in set(self.upload_sessions) | set(self.pending_uploads):
+                self.uploads.enqueue(fid)
+        except Exception as e:
+            warn('Failed to load the drive: {}'.format(e))
+            self.start_error = e
+        finally:
+            self.started.set()
+
     def _build_cache(self):
         # Build a locally cached version of the Google Drive by downloading
-        # all files to the temporary directory.
+        # all files to the temporary directory (or just their metadata in lazy mode).
         dbg('Building local cache')
+        # Folder listings are fetched page by page by a pool of workers, but the results 
+        # are processed on this thread, since the local state isn't thread-safe.
+        with ThreadPoolExecutor(max_workers=self.crawl_workers) as pool:
+            def list_folder(dir_id, page_token=None):
+                query = "'{}' in parents".format(dir_id)
+                return pool.submit(self.api.scheduler.in_background(self.api.list_page), query, page_token)
+            pending = {list_folder(self.root_id): ('', self.root_id)}
+            while len(pending) != 0:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, dir_id = pending.pop(future)
+                    items, page_token = future.result()
+                    if page_token is not None:
+                        # keep listing a large folder while processing what we have so far
+                        pending[list_folder(dir_id, page_token)] = (path, dir_id)
+                    for new_path, item in self._cache_listing(path, items):
+                        # this is a directory, so start listing it too
+                        pending[list_folder(item[ID])] = (new_path, item[ID])
+
+    def _cache_listing(self, path, items, stub=False):
+        # Cache the items listed in the directory at remote path 'path',
+        # and return the (path, item) pairs for the subdirectories
+        subdirs = []
+        for item in items:
+            if item[TRASHED] and not self._in_trash(path):
+                new_path = self.trash_dir+'/'+item[NAME]
+            else:
+                new_path = path+'/'+item[NAME]
+            self._cache(item, new_path, stub)
+            if item[MTYPE] == FOLDER_MTYPE:
+                subdirs.append((new_path, item))
+        return subdirs
+
+    def _load_index(self):
+        # Rebuild the local state from the index saved by the last mount, 
+        # reusing any local copies that are still valid, and then catch up on 
+        # the remote changes since. Returns False if the index can't be used.
+        state = self.index.load_state()
+        if state.get('root_id') != self.root_id or state.get('types') != repr(self.api.types):
+            # a different account or configuration
+            return False
+        rows = self.index.load_items()
+        dbg('Rebuilding local state from {} indexed items', len(rows))
+        # set aside the local copies that still match their metadata, 
+        # and any modified ones along with the pending uploads
+        if os.path.exists(self.reuse_dir):
+            shutil.rmtree(self.reuse_dir)
+        os.makedirs(self.reuse_dir)
+        reusable = dict()
+        for item, rpath, content, blocks in rows:
+            if item[MTYPE] == FOLDER_MTYPE or content == STUB:
+                continue
+            lpath = self._lpath(rpath)
+            if not os.path.isfile(lpath):
+                continue
+            if os.path.getmtime(lpath) == tstr_to_posix(item.get(MTIME)):
+                os.rename(lpath, os.path.join(self.reuse_dir, item[ID]))
+                reusable[item[ID]] = (content, blocks)
+            elif content == FETCHED:
+                os.rename(lpath, os.path.join(self.pending_dir, item[ID]))
+        # reassemble the hierarchy from the parents of each item, with placeholders 
+        # for now (even in eager mode), since most of them get replaced right after
+        self._reset_tmp()
+        id_to_listing = dict()
+        for item, rpath, content, blocks in rows:
+            id_to_listing.setdefault(item[PARENTS][0], []).append(item)
         stack = [('', self.root_id)]
         while len(stack) != 0:
-            cur = stack.pop()
-            path = cur[0]
-            dir_id = cur[1]
-            items = self.api.exec_query("'{}' in parents".format(dir_id))
-            if not items:
+            path, dir_id = stack.pop()
+            for new_path, item in self._cache_listing(path, id_to_listing.get(dir_id, []), stub=True):
+                stack.append((new_path, item[ID]))
+        # put the reusable copies back in place
+        for fid, (content, blocks) in reusable.items():
+            if not fid in self.tree:
                 continue
-            for item in items:
-                if item[TRASHED] and not self._in_trash(path):
-                    new_path = self.trash_dir+'/'+item[NAME]
-                else:
-                    new_path = path+'/'+item[NAME]
-                self._cache(item, new_path)
-                # if this is a directory, so add it to the stack for processing
-                if item[MTYPE] == FOLDER_MTYPE:
-                    stack.append((new_path, item[ID]))
+            item = self.id_to_item[fid]
+            lpath = self._lpath(self.tree.path(fid))
+            os.replace(os.path.join(self.reuse_dir, fid), lpath)
+            if content == FETCHED:
+                self.unfetched.discard(fid)
+                self.id_to_blocks.pop(fid, None)
+            elif fid in self.id_to_blocks:
+                self.id_to_blocks[fid].restore(blocks)
+            os.utime(lpath, (tstr_to_posix(item.get(ATIME)), tstr_to_posix(item.get(MTIME))))
+            self._account(fid, lpath)
+        shutil.rmtree(self.reuse_dir)
+        # catch up on what happened since the last mount
+        self.changes_token = state['changes_token']
+        try:
+            changes, self.changes_token = self.api.list_changes(self.changes_token)
+        except Exception as e:
+            dbg('Failed to list changes since the last mount: {}', e)
+            self._clear_state()
+            return False
+        self._apply_changes(changes)
+        self._restore_pending()
+        if not self.lazy:
+            # eager mounts still download everything else (which changed files already were)
+            for fid in list(self.unfetched):
+                item = self.id_to_item[fid]
+                if not fid in reusable and not item[MTYPE] in self.api.types:
+                    self._store(item, self._lpath(self.tree.path(fid)))
+        return True
+
+    def _set_aside_pending(self):
+        # Move the local copies of the files that were waiting to be uploaded out of the 
+        # cache directory, which gets rebuilt, and into the pending directory. Copies left 
+        # there by a previous attempt are kept.
+        if not os.path.exists(self.pending_dir):
+            os.makedirs(self.pending_dir)
+        for fid, rpath in self.pending_uploads.items():
+            lpath = self._lpath(rpath)
+            if os.path.isfile(lpath):
+                os.replace(lpath, os.path.join(self.pending_dir, fid))
+        if len(os.listdir(self.pending_dir)) != 0:
+            dbg('Found {} modified files that still have to be uploaded', len(os.listdir(self.pending_dir)))
 
-    def _cache(self, item, rpath):
-        # Cache the file 'item' at the remote path 'rpath'
-        dbg('Caching file "{}" at "{}".'.format(item[NAME], rpath))
-        # add extension
+    def _restore_pending(self):
+        # Put the local copies in the pending directory back in place once the cache has 
+        # been rebuilt, as modified files (which they are, compared with any version of the 
+        # metadata), so they get uploaded
+        restored = set()
+        for fid in os.listdir(self.pending_dir):
+            path = os.path.join(self.pending_dir, fid)
+            item = self.id_to_item.get(fid)
+            if item is None or item[MTYPE] == FOLDER_MTYPE:
+                warn('Dropping the local changes to file ID "{}", which no longer exists'.format(fid))
+                os.remove(path)
+                self._forget_pending(fid)
+                continue
+            lpath = self._lpath(self.tree.path(fid))
+            os.replace(path, lpath)
+            self.unfetched.discard(fid)
+            self.id_to_blocks.pop(fid, None)
+            self.deferred.discard(fid)
+            self.local_attrs.add(fid)
+            self._account(fid, lpath)
+            self._record_pending(fid)
+            restored.add(fid)
+        # files that were recorded but have no local copy anymore were removed
+        for fid in list(self.pending_uploads):
+            if not fid in restored:
+                self._forget_pending(fid)
+
+    def _save_index(self):
+        # Snapshot the local state into the metadata index. Only copying the state holds
+        # the lock, turning it into rows (which computes every path) and writing them doesn't.
+        with self.lock:
+            self.index_dirty = False
+            state = {
+                'root_id': self.root_id,
+                'changes_token': self.changes_token,
+                'types': repr(self.api.types),
+            }
+            tree = self.tree.copy()
+            items = dict(self.id_to_item)
+            unfetched = set(self.unfetched)
+            bitmaps = dict((fid, bytes(blocks.bitmap)) for fid, blocks in self.id_to_blocks.items())
+        rows = []
+        for fid, item in items.items():
+            blocks = bitmaps.get(fid)
+            if blocks is not None:
+                content = PARTIAL
+            elif fid in unfetched:
+                content = STUB
+            else:
+                content = FETCHED
+            rows.append((fid, item, tree.path(fid), content, blocks))
+        self.index.save(state, rows)
+
+    def _clear_state(self):
+        # Forget all cached metadata
+        # Maps between IDs and paths. The trash directory uses the 'root' alias as its ID,
+        # so that files created in it get registered under the root.
+        self.tree = PathIndex(self.root_id) # TODO: deal with duplicate paths
+        self.tree.add(self.trash_dir, 'root', is_dir=True)
+        self.id_to_item = dict()
+        # Maps folder IDs to the set of IDs of their (Drive) children
+        self.id_to_children = dict()
+        # IDs of files whose local copy is only a placeholder
+        self.unfetched = set()
+        # Sparse local copies of unfetched files that can be read block by block
+        self.id_to_blocks = dict()
+        # IDs of files that eager mode cached as placeholders while the lock was held,
+        # which are downloaded once it's released (see _fetch_deferred)
+        self.deferred = set()
+        # Disk usage and recency of the local copies that have (some) contents
+        self.quota = CacheQuota(self.cache_size, self.cache_files)
+        # Maps file IDs to their number of open handles
+        self.open_files = dict()
+        # Maps IDs of open files that changed remotely to the item of the version their local 
+        # copy is of. Their handles keep using that copy, which is replaced once they're all closed.
+        self.stale = dict()
+        # Maps file IDs to the (item, mode, size, atime, mtime) records getattr is answered from,
+        # which are recomputed whenever the item changes
+        self.id_to_attrs = dict()
+        # IDs of files whose attributes have been changed locally, and have to be read 
+        # from the local copy instead
+        self.local_attrs = set()
+
+    def _cache(self, item, rpath, stub=False):
+        # Cache the file 'item' at the remote path 'rpath' (only as a placeholder if 'stub' is set)
+        dbg('Caching file "{}" at "{}".', item[NAME], rpath)
         mimetype = item[MTYPE]
-        if mimetype in self.api.types:
-            ext = self.api.types[mimetype][1]
-            if len(rpath) > len(ext) and rpath[len(rpath)-len(ext):] != ext:
-                rpath += ext
+        rpath = self._add_ext(rpath, mimetype)
         lpath = self._lpath(rpath)
         # fix up internal state caches
         fid = item[ID]
-        self.path_to_id[rpath] = fid
+        self.tree.add(rpath, fid, mimetype == FOLDER_MTYPE)
         self.id_to_item[fid] = item
         parent = item[PARENTS][0]
-        if not parent in self.id_to_children:
-            self.id_to_children[parent] = []
-        self.id_to_children[parent].append(fid) 
+        self.id_to_children.setdefault(parent, set()).add(fid)
         if mimetype == FOLDER_MTYPE: 
-            self.id_to_children[fid] = []
-        # download the file
-        self.api.download(item, lpath)
+            self.id_to_children.setdefault(fid, set())
+        self._store(item, lpath, stub)
+
+    def _store(self, item, lpath, stub=False):
+        # (Re)create the local copy of 'item' at the local path 'lpath'.
+        # If 'stub' is set, only a placeholder is created even in eager mode.
+        fid = item[ID]
+        mimetype = item[MTYPE]
+        self.id_to_blocks.pop(fid, None)
+        self.quota.remove(fid)
+        self.local_attrs.discard(fid)
+        if mimetype != FOLDER_MTYPE and os.path.exists(lpath):
+            # replace (rather than overwrite) any old copy, so fetches of the old version
+            # still in progress can't write into the new one
+            os.remove(lpath)
+        # Workspace documents are only exported when they're opened, even in eager mode, 
+        # since exports are slow and have a low quota
+        if (self.lazy or stub or mimetype in self.api.types) and mimetype != FOLDER_MTYPE:
+            # only create a placeholder, the contents are fetched on first open
+            open(lpath, 'wb').close()
+            self.unfetched.add(fid)
+            if not mimetype in self.api.types:
+                # regular files are fetched in blocks as they are read, so make a sparse 
+                # file of the right size which gets filled in by read()
+                size = int(item.get(SIZE, 0))
+                if size == 0:
+                    self.unfetched.discard(fid)
+                else:
+                    os.truncate(lpath, size)
+                    self.id_to_blocks[fid] = BlockMap(size)
+        else:
+            # download the file
+            self.api.download(item, lpath, cache=False)
+            self.unfetched.discard(fid)
+            if mimetype != FOLDER_MTYPE:
+                self._account(fid, lpath)
         # fix up file time metadata
         atime = tstr_to_posix(item.get(ATIME))
         mtime = tstr_to_posix(item.get(MTIME))
         os.utime(lpath, (atime, mtime))
 
-    def _get_rpath(self, item):
-        # Calculates the remote path for an item
-        dbg('Getting remote path for item {}'.format(item))
-        rpath = item[NAME]
-        # add extension
-        mimetype = item[MTYPE]
+    def _file_lock(self, fid):
+        # Returns the lock serializing fetches, writes and uploads of a file
+        with self.lock:
+            if not fid in self.file_locks:
+                self.file_locks[fid] = threading.RLock()
+            return self.file_locks[fid]
+
+    @contextlib.contextmanager
+    def _locked_dirs(self, *rpaths):
+        # Hold the locks of the directories at 'rpaths' (in a consistent order, so holding 
+        # two can't deadlock). Operations that change directories on the remote hold these 
+        # instead of self.lock while waiting for the remote.
+        with self.lock:
+            dir_ids = sorted(set(self.tree.lookup(rpath) for rpath in rpaths).difference([None]))
+        locks = [self._file_lock(dir_id) for dir_id in dir_ids]
+        with contextlib.ExitStack() as stack:
+            for lock in locks:
+                stack.enter_context(lock)
+            yield
+
+    def _fetch(self, fid):
+        # Make sure the contents of a lazily cached file are present locally.
+        # This downloads without holding self.lock, so it must not be called with it held.
+        with self._file_lock(fid):
+            with self.lock:
+                if not fid in self.unfetched:
+                    return
+                item = self.id_to_item[fid]
+                blocks = self.id_to_blocks.get(fid)
+            if blocks is not None:
+                # only fill in the blocks that are still missing
+                self._fetch_range(fid, 0, blocks.size)
+                return
+            dbg('Fetching contents of file ID "{}".', fid)
+            # download outside of the cache directory, since the file might be moved meanwhile
+            download_path = os.path.join(self.download_dir, fid)
+            if item[MTYPE] in self.api.types:
+                self._export(item, download_path)
+            else:
+                self.api.download(item, download_path, cache=False)
+            with self.lock:
+                cur_item = self.id_to_item.get(fid)
+                if cur_item is None or cur_item[MTIME] != item[MTIME]:
+                    # the file was changed or removed while downloading
+                    os.remove(download_path)
+                    retry = cur_item is not None
+                else:
+                    lpath = self._lpath(self.tree.path(fid))
+                    os.replace(download_path, lpath)
+                    os.utime(lpath, (tstr_to_posix(item.get(ATIME)), tstr_to_posix(item.get(MTIME))))
+                    self.unfetched.discard(fid)
+                    self.stale.pop(fid, None)
+                    self._account(fid, lpath)
+                    self._evict(keep=fid)
+                    retry = False
+            if retry:
+                self._fetch(fid)
+
+    def _export(self, item, path):
+        # Export a Workspace document to 'path', unless this version has been exported before
+        mimetype = self.api.types[item[MTYPE]][0]
+        if self.exports.get(item[ID], item[MTIME], mimetype, path):
+            self.metrics.count('cache_hits', cache='exports')
+            return
+        self.metrics.count('cache_misses', cache='exports')
+        self.api.download(item, path, cache=False)
+        self.exports.put(item[ID], item[MTIME], mimetype, path)
+
+    def _fetch_range(self, fid, start, end):
+        # Make sure the bytes [start, end) of a sparse local copy are present.
+        # Like _fetch, this must not be called with self.lock held.
+        with self._file_lock(fid):
+            with self.lock:
+                blocks = self.id_to_blocks.get(fid)
+                if blocks is None:
+                    return
+                ranges = blocks.missing(start, end)
+                if not ranges:
+                    return
+                item = self._version(fid)
+                # the descriptor stays valid even if the file is moved while downloading
+                fd = os.open(self._lpath(self.tree.path(fid)), os.O_WRONLY)
+            # Each request fetches at most a download chunk (rounded to whole blocks), 
+            # so filling in a large file doesn't hold all of it in memory
+            step = max(self.api.chunk_size//blocks.block_size, 1)*blocks.block_size
+            # The blocks come from the revision the local copy is of, even if the file has changed 
+            # since (and is still open), so a sparse copy never mixes blocks of different versions
+            revision = item.get(HEAD_REVISION)
+            try:
+                for range_start, range_end in ranges:
+                    for chunk_start in range(range_start, range_end, step):
+                        chunk_end = min(chunk_start+step, range_end)
+                        data = self.api.download_range(fid, chunk_start, chunk_end, revision)
+                        os.pwrite(fd, data, chunk_start)
+                        blocks.fill(chunk_start, chunk_end)
+                # filling in blocks must not look like a local modification
+                atime = tstr_to_posix(item.get(ATIME))
+                mtime = tstr_to_posix(item.get(MTIME))
+                os.utime(fd, (atime, mtime))
+            finally:
+                os.close(fd)
+            with self.lock:
+                if self.id_to_blocks.get(fid) is not blocks:
+                    # the file was changed or evicted meanwhile
+                    return
+                if blocks.complete():
+                    dbg('All blocks of file ID "{}" are present.', fid)
+                    del self.id_to_blocks[fid]
+                    self.unfetched.discard(fid)
+                self._account(fid, self._lpath(self.tree.path(fid)))
+                self._evict(keep=fid)
+
+    def _account(self, fid, lpath):
+        # Update the disk usage of a local copy, and mark it as recently used
+        self.quota.touch(fid, os.stat(lpath).st_blocks*512)
+
+    def _version(self, fid):
+        # Returns the item of the version that the local copy of a file is of
+        return self.stale.get(fid) or self.id_to_item[fid]
+
+    def _replace(self, old_item, lpath):
+        # Replace the local copy of a file that is of version 'old_item' with one of the 
+        # latest version. If the file is open, this waits until it's closed, since its handles 
+        # point at the old copy (and fill it in, if it's sparse).
+        fid = old_item[ID]
+        if fid in self.open_files:
+            self.stale.setdefault(fid, old_item)
+        else:
+            self._store(self.id_to_item[fid], lpath, stub=True)
+            self._defer_fetch(fid)
+
+    def _defer_fetch(self, fid):
+        # Mark a file that was cached as a placeholder while holding the lock to be downloaded 
+        # once it's released, in eager mode, so downloads don't hold up other operations
+        if not self.lazy:
+            self.deferred.add(fid)
+
+    def _fetch_deferred(self):
+        # Download the files marked by _defer_fetch. Like _fetch, this must not be called 
+        # with self.lock held.
+        while True:
+            with self.lock:
+                if len(self.deferred) == 0:
+                    return
+                fid = self.deferred.pop()
+                item = self.id_to_item.get(fid)
+                if item is None or item[MTYPE] in self.api.types:
+                    # Workspace documents are only exported when they're opened
+                    continue
+                # the whole file is downloaded at once, rather than block by block
+                self.id_to_blocks.pop(fid, None)
+            try:
+                self._fetch(fid)
+            except Exception as e:
+                dbg('Failed to fetch file ID "{}": {}', fid, e)
+
+    def _attrs_changed(self, rpath):
+        # Answer getattr from the local copy of a file from now on
+        fid = self.tree.lookup(rpath)
+        if fid in self.id_to_item:
+            self.local_attrs.add(fid)
+
+    def _opened(self, fid):
+        self.open_files[fid] = self.open_files.get(fid, 0)+1
+
+    def _closed(self, fid):
+        if self.open_files.get(fid, 0) > 1:
+            self.open_files[fid] -= 1
+        else:
+            self.open_files.pop(fid, None)
+
+    def _pinned(self, fid):
+        # Returns whether the local copy of a file has to be kept
+        if fid in self.open_files or fid in self.uploads or fid in self.upload_sessions:
+            return True
+        # modified files are kept until they have been uploaded
+        return self._modified(fid)
+
+    def _modified(self, fid):
+        # Returns whether the local copy of a file has changes that haven't been uploaded
+        if not fid in self.id_to_item or fid in self.unfetched:
+            return False
+        lpath = self._lpath(self.tree.path(fid))
+        return os.path.getmtime(lpath) != tstr_to_posix(self._version(fid).get(MTIME))
+
+    def _evict(self, keep=None):
+        # Turn the least recently used local copies back into placeholders until
+        # the cache is within its quota. 'keep' is never evicted.
+        if not self.quota.over():
+            return
+        for fid in self.quota.lru():
+            if not self.quota.over():
+                break
+            if fid == keep or not fid in self.id_to_item or self._pinned(fid):
+                continue
+            file_lock = self._file_lock(fid)
+            if not file_lock.acquire(blocking=False):
+                # it's being fetched or uploaded
+                continue
+            try:
+                dbg('Evicting local copy of file ID "{}"', fid)
+                self._store(self.id_to_item[fid], self._lpath(self.tree.path(fid)), stub=True)
+            finally:
+                file_lock.release()
+        if self.quota.over():
+            dbg('Cache is over its quota, but everything else is in use')
+
+    def _scan_prefetch(self, fid, name):
+        # Returns the IDs of the files to prefetch after the file 'name' was opened, if its
+        # directory is being scanned: the small ones that haven't been fetched yet, 
+        # starting with the ones after it in name order. Prefetching never evicts anything.
+        dir_id = self.tree.parent(fid)
+        if not self.prefetcher.enabled() or dir_id is None or not self.prefetcher.opened(dir_id, name):
+            return []
+        entries = sorted(self.tree.entries(dir_id))
+        entries = [e for e in entries if e[0] > name]+[e for e in entries if e[0] < name]
+        room = self.cache_size-self.quota.total if self.cache_size else None
+        files_room = self.cache_files-len(self.quota) if self.cache_files else None
+        fids = []
+        for _, sibling in entries:
+            if len(fids) == self.prefetch_files or files_room == 0:
+                break
+            item = self.id_to_item.get(sibling)
+            if not sibling in self.unfetched or sibling in self.open_files or not SIZE in item:
+                continue
+            size = int(item[SIZE])
+            if size > self.prefetch_size or (room is not None and size > room):
+                continue
+            if room is not None:
+                room -= size
+            if files_room is not None:
+                files_room -= 1
+            fids.append(sibling)
+        return fids
+
+    def _attrs(self, fid):
+        # Returns the attributes of a file according to its Drive metadata, 
+        # or None if they have to come from the local copy
+        item = self.id_to_item[fid]
+        record = self.id_to_attrs.get(fid)
+        if record is None or record[0] is not item:
+            if item[MTYPE] == FOLDER_MTYPE:
+                mode, size = DIR_MODE, DIR_SIZE
+            elif SIZE in item:
+                mode, size = FILE_MODE, int(item[SIZE])
+            elif fid in self.unfetched:
+                # Workspace documents have no size until they're exported, so this is the size 
+                # of the cached export of this version, or an upper bound. The kernel caches 
+                # the size, and doesn't read past it, but it shrinks it when a read stops 
+                # short at the real end.
+                size = self.exports.size(fid, item[MTIME], self.api.types.get(item[MTYPE], (None,))[0])
+                return self._make_attrs(inode(fid), FILE_MODE, EXPORT_SIZE if size is None else size,
+                                        tstr_to_posix(item.get(ATIME)), tstr_to_posix(item.get(MTIME)))
+            else:
+                return None
+            record = (item, inode(fid), mode, size, tstr_to_posix(item.get(ATIME)), tstr_to_posix(item.get(MTIME)))
+            self.id_to_attrs[fid] = record
+        return self._make_attrs(*record[1:])
+
+    def _make_attrs(self, ino, mode, size, atime, mtime):
+        return {
+            'st_ino': ino,
+            'st_mode': mode,
+            'st_nlink': 2 if stat.S_ISDIR(mode) else 1,
+            'st_size': size,
+            'st_blocks': (size+511)//512,
+            'st_atime': atime,
+            'st_mtime': mtime,
+            'st_ctime': mtime,
+            'st_uid': self.uid,
+            'st_gid': self.gid,
+        }
+
+    def _control(self, op, path, *args):
+        # Serve an operation on CONTROL_DIR or the files in it
+        name = path[len(CONTROL_DIR)+1:]
+        if path != CONTROL_DIR and not name in CONTROL_FILES:
+            raise FuseOSError(errno.ENOENT)
+        if op == 'getattr':
+            if path == CONTROL_DIR:
+                return self._make_attrs(inode(path), DIR_MODE & ~0o222, DIR_SIZE, self.mounted_at, self.mounted_at)
+            return self._make_attrs(inode(path), FILE_MODE & ~0o222, CONTROL_SIZE, time.time(), time.time())
+        if op == 'readdir' and path == CONTROL_DIR:
+            return ['.', '..']+list(CONTROL_FILES)
+        if op == 'access':
+            if args[0] & os.W_OK:
+                raise FuseOSError(errno.EACCES)
+            return 0
+        if op == 'open' and path != CONTROL_DIR:
+            if args[0] & (os.O_WRONLY | os.O_RDWR):
+                raise FuseOSError(errno.EACCES)
+            # a real descriptor, just to get a handle that can't be confused with others
+            fh = os.open(os.devnull, os.O_RDONLY)
+            self.control_handles[fh] = CONTROL_FILES[name](self.metrics).encode()
+            return fh
+        if op == 'read' and path != CONTROL_DIR:
+            length, offset, fh = args
+            return self.control_handles[fh][offset:offset+length]
+        if op == 'release' and path != CONTROL_DIR:
+            fh = args[0]
+            del self.control_handles[fh]
+            os.close(fh)
+            return 0
+        if op in ('flush', 'opendir', 'releasedir'):
+            return 0
+        if op == 'statfs':
+            return self.statfs('/')
+        if op in ('getxattr', 'listxattr'):
+            return super().__call__(op, path, *args)
+        raise FuseOSError(errno.EACCES)
+
+    def _add_ext(self, rpath, mimetype):
+        # Add the configured extension to the path of exported Workspace documents
         if mimetype in self.api.types:
             ext = self.api.types[mimetype][1]
             if len(rpath) > len(ext) and rpath[len(rpath)-len(ext):] != ext:
                 rpath += ext
-        # Iteratively compute the remote path
-        cur_item = item
-        is_trashed = item[TRASHED]
-        while True:
-            cur_item = self.api.get_file(cur_item[PARENTS][0])
-            if cur_item[NAME] == self.root_name:
-                # TODO other cases like shared drives
-                rpath = '/'+rpath
-                break
-            rpath = cur_item[NAME]+'/'+rpath
-        if is_trashed:
-            rpath = self.trash_dir+rpath
         return rpath
 
     def _get_cached_rpath(self, fid):
-        for rp, f in self.path_to_id.items():
-            if f == fid: 
-                return rp
-        err('Failed to find file ID "{}" in local state!'.format(fid))
+        rpath = self.tree.path(fid)
+        if rpath is None:
+            err('Failed to find file ID "{}" in local state!'.format(fid))
+        return rpath
 
-    def _update_in_hierarchy(self, old_rpath, old_item, new_item):
+    def _get_local_rpath(self, item):
+        # Calculates the remote path for an item using only the cached metadata.
+        # Returns None if the item's parent isn't cached.
+        parent = item[PARENTS][0]
+        if parent == self.root_id:
+            parent_rpath = ''
+        elif parent in self.id_to_item:
+            parent_rpath = self._get_cached_rpath(parent)
+        else:
+            return None
+        if item[TRASHED] and not self._in_trash(parent_rpath):
+            parent_rpath = self.trash_dir
+        return self._add_ext(parent_rpath+'/'+item[NAME], item[MTYPE])
+
+    def _update_in_hierarchy(self, old_rpath, old_item, new_item, new_rpath=None):
         # Move a cached file to its new path, and update internal state
         # find new location in hierarchy
-        new_rpath = self._get_rpath(new_item)
-        dbg('Moving cached file at "{}" to "{}".'.format(old_rpath, new_rpath))
-        dbg('Old item: {}'.format(old_item))
-        dbg('New item: {}'.format(new_item))
+        if new_rpath is None:
+            new_rpath = self._get_local_rpath(new_item)
+            if new_rpath is None:
+                # The new parent isn't cached (it may not even be in My Drive), so there's 
+                # nowhere to move it to. It gets cached again once its parent is.
+                dbg('New parent of "{}" is not cached, removing it from the cache', old_rpath)
+                self._remove_from_cache(old_item, old_rpath)
+                return
+        dbg('Moving cached file at "{}" to "{}".', old_rpath, new_rpath)
+        dbg('Old item: {}', old_item)
+        dbg('New item: {}', new_item)
         # move the file
         old_lpath = self._lpath(old_rpath)
         new_lpath = self._lpath(new_rpath)
         os.rename(old_lpath, new_lpath)
-        # fix internal state
+        # fix internal state (everything under a directory moves along with it)
         fid = new_item[ID]
-        del self.path_to_id[old_rpath]
-        self.path_to_id[new_rpath] = fid
+        self.tree.move(fid, new_rpath)
         self.id_to_item[fid] = new_item
+        # (which may have moved files waiting to be uploaded)
+        for pending_fid in list(self.pending_uploads):
+            self._record_pending(pending_fid)
         old_parent = old_item[PARENTS][0]
         new_parent = new_item[PARENTS][0]
-        if fid in self.id_to_children[old_parent]:
-            self.id_to_children[old_parent].remove(fid)
-        self.id_to_children[new_parent].append(fid)
+        self.id_to_children.get(old_parent, set()).discard(fid)
+        self.id_to_children.setdefault(new_parent, set()).add(fid)
 
-    def _update_directory(self, fid, rpath):
-        # Update folder contents
+    def _update_directory(self, fid):
+        # Update folder contents. The folder is listed without holding self.lock, which is 
+        # only taken to apply the listing, but with its own lock held, so local changes to 
+        # it wait for the listing instead of being undone by it.
         dbg('Updating directory contents.')
-        new_children_items = self.api.exec_query('"{}" in parents'.format(fid))
-        new_children = set([child_item[ID] for child_item in new_children_items])
-        old_children = set(self.id_to_children[fid])
-        for new_child in new_children.difference(old_children):
-            # cache new children
-            for new_child_item in new_children_items:
-                child_id = new_child_item[ID]
-                if child_id == new_child:
+        with self._file_lock(fid):
+            new_children_items = dict()
+            for child_item in self.api.iter_query('"{}" in parents'.format(fid)):
+                new_children_items[child_item[ID]] = child_item
+            new_children = set(new_children_items)
+            with self.lock:
+                removed_children = set(self.id_to_children.get(fid, ())).difference(new_children)
+            # find out where the old children went, all at once
+            new_items = self.api.get_files(removed_children) if removed_children else dict()
+            with self.lock:
+                if not fid in self.id_to_children:
+                    # the folder was removed meanwhile
+                    return
+                # (it may have been moved meanwhile, too)
+                rpath = '' if fid == self.root_id else self._get_cached_rpath(fid)
+                old_children = set(self.id_to_children[fid])
+                for child_id in new_children.difference(old_children):
+                    # cache new children
+                    new_child_item = new_children_items[child_id]
                     if child_id in self.id_to_item:
                         # new child came from another directory
                         old_rpath = self._get_cached_rpath(child_id)
                         self._update_in_hierarchy(old_rpath, self.id_to_item[child_id], new_child_item)
                     else:
                         child_rpath = rpath+'/'+new_child_item[NAME]
-                        self._cache(new_child_item, child_rpath)
-                    break
-        for removed_child in old_children.difference(new_children):
-            # remove old children
-            removed_item = self.id_to_item[removed_child]
-            removed_rpath = rpath+'/'+removed_item[NAME]
-            new_item = self.api.get_file(removed_item[ID])
-            if new_item:
-                # item exists somewhere else, so update it
-                self._update_in_hierarchy(removed_rpath, removed_item, new_item)
-            else:
-                # remove the item
-                self._remove_from_cache(removed_item, removed_rpath)
-        # TODO check for trashed/untrashed items
+                        self._cache(new_child_item, child_rpath, stub=True)
+                        self._defer_fetch(child_id)
+                for removed_child in removed_children.intersection(old_children):
+                    # remove old children
+                    removed_item = self.id_to_item[removed_child]
+                    removed_rpath = self._get_cached_rpath(removed_child)
+                    new_item = new_items.get(removed_child)
+                    if new_item:
+                        # item exists somewhere else, so update it
+                        self._update_in_hierarchy(removed_rpath, removed_item, new_item)
+                    else:
+                        # remove the item
+                        self._remove_from_cache(removed_item, removed_rpath)
+                # TODO check for trashed/untrashed items
+        self._fetch_deferred()
 
     def _remove_from_cache(self, item, rpath):
-        dbg('Removing "{}" from the cache'.format(rpath))
+        dbg('Removing "{}" from the cache', rpath)
         lpath = self._lpath(rpath)
+        fid = item[ID]
         if item[MTYPE] != FOLDER_MTYPE:
             os.remove(lpath)
         else:
-            # Make sure the directory is empty
-            children = os.listdir(lpath)
-            while len(children) > 0:
-                child = children.pop()
-                child_rpath = rpath+'/'+child
-                if child_rpath in self.path_to_id:
-                    # Child file exists, but was moved
-                    child_id = self.path_to_id[child_rpath]
-                    child_item = self.api.get_file(fid)
-                    old_child_item = self.id_to_item[child_id]
-                    self._update_in_hierarchy(child_rpath, old_child_item, child_item)
-                else:
-                    # Child file is gone too, so remove the child file
-                    child_lpath = lpath+'/'+child
-                    os.remove(child_lpath)
+            # Anything still cached under the directory went away with it
+            # (children that were moved elsewhere get cached again when they're seen)
+            for child_id in list(self.id_to_children[fid]):
+                child_rpath = self._get_cached_rpath(child_id)
+                self._remove_from_cache(self.id_to_item[child_id], child_rpath)
             # Finally, remove the directory
-            os.rmdir(lpath)
-            del self.id.to_children[item[ID]]
-        del self.path_to_id[rpath]
+            shutil.rmtree(lpath)
+            del self.id_to_children[fid]
+        parent = item[PARENTS][0]
+        self.id_to_children.get(parent, set()).discard(fid)
+        self.tree.remove(fid)
         del self.id_to_item[item[ID]]
+        self.unfetched.discard(item[ID])
+        self.id_to_blocks.pop(item[ID], None)
+        self.file_locks.pop(item[ID], None)
+        self.quota.remove(item[ID])
+        self.id_to_attrs.pop(item[ID], None)
+        self.local_attrs.discard(item[ID])
+        self.stale.pop(item[ID], None)
 
     def _refresh_local(self, rpath):
         # Ensure that the local copy of a file is up-to-date with the remote version.
-        dbg('Refreshing local copy of "{}".'.format(rpath))
+        # The remote is asked without holding self.lock, which is only taken to apply 
+        # what it said, so this must not be called with it held.
+        dbg('Refreshing local copy of "{}".', rpath)
         if rpath == '/':
             # If this is the root, update the dir contents, then return
-            self._update_directory(self.root_id, '')
+            self._update_directory(self.root_id)
             return
         if rpath == self.trash_dir:
             # If this is the trash dir, update the dir contents (TODO)
             return
 
-        if rpath not in self.path_to_id:
-            # Path not cached locally
-            tree = re.split('/+', rpath)
-            fname = tree[-1]
-            items = self.api.exec_query('name = "{}"'.format(fname))
-            # Quick check to see if this filename even exists
-            if len(items) == 0:
+        with self.lock:
+            fid = self.tree.lookup(rpath)
+        if fid is None:
+            # Path not cached locally, so look it up remotely 
+            # (the API caches lookups, so probing for missing files stays cheap)
+            item = self.api.traverse_path(rpath, self.root_id)
+            if item is None:
                 dbg('File not found remotely.')
                 return
-            # If such a filename exists, let's make sure we get the right one
-            item = self.api.traverse_path(rpath)
-            if not item[ID] in self.id_to_item:
-                # Cache this new file, and we're done
-                self._cache(item, rpath)
-                return
-            elif item[PARENTS][0] != self._get_parent(rpath):
-                # This was not the file we were looking for
+            with self.lock:
+                if not item[ID] in self.id_to_item:
+                    # Cache this new file, and we're done
+                    self._cache(item, rpath, stub=True)
+                    self._defer_fetch(item[ID])
+                    new = True
+                elif item[PARENTS][0] != self._get_parent(rpath):
+                    # This was not the file we were looking for
+                    return
+                else:
+                    # File was cached under a different path, so let's just restart the whole check
+                    # (this could be made a little more efficient, but it's a rare case)
+                    new = False
+            if new:
+                self._fetch_deferred()
                 return
-            else:
-                # File was cached under a different path, so let's just restart the whole check
-                # (this could be made a little more efficient, but it's a rare case)
-                rpath = self._get_cached_rpath(fid)
+            fid = item[ID]
 
         # File cached locally
-        lpath = self._lpath(rpath)
-        fid = self.path_to_id[rpath]
         # TODO there is a case where a file is replaced by a new file,
         # which is currently not accounted for here
-        local_item = self.id_to_item[fid]
         remote_item = self.api.get_file(fid)
-        self.id_to_item[fid] = remote_item
-        if not remote_item:
-            dbg('File does not exist anymore!')
-            self._remove_from_cache(local_item, rpath)
-        else:
+        with self.lock:
+            local_item = self.id_to_item.get(fid)
+            if local_item is None:
+                # it was removed meanwhile
+                return
+            rpath = self._get_cached_rpath(fid)
+            if not remote_item:
+                dbg('File does not exist anymore!')
+                self._remove_from_cache(local_item, rpath)
+                return
+            self.id_to_item[fid] = remote_item
             if local_item[MTYPE] != remote_item[MTYPE]:
                 # This should never happen.
                 err('Mimetype changed!') 
-            if local_item[PARENTS] != remote_item[PARENTS]:
-                dbg('Parents changed!')
-                self._update_in_hierarchy(rpath, local_item, remote_item)
-            if local_item[TRASHED] != remote_item[TRASHED]:
-                if local_item[TRASHED]:
+            if local_item[PARENTS] != remote_item[PARENTS] or local_item[TRASHED] != remote_item[TRASHED]:
+                if local_item[PARENTS] != remote_item[PARENTS]:
+                    dbg('Parents changed!')
+                elif local_item[TRASHED]:
                     dbg('File remotely restored!')
                 else:
                     dbg('File remotely trashed!')
                 self._update_in_hierarchy(rpath, local_item, remote_item)
+                if not fid in self.id_to_item:
+                    # it was moved out of the cached hierarchy
+                    return
             if local_item[MTIME] < remote_item[MTIME]:
                 dbg('Locally cached copy is stale!')
-                self._cache(remote_item, rpath)
-            if remote_item[MTYPE] == FOLDER_MTYPE:
-                self._update_directory(fid, rpath)
+                self._replace(local_item, self._lpath(self.tree.path(fid)))
+        self._fetch_deferred()
+        if remote_item[MTYPE] == FOLDER_MTYPE:
+            self._update_directory(fid)
+
+    def _revalidate(self, rpath, fid):
+        # Re-list a directory in the background
+        if fid in self.revalidating:
+            return
+        self.revalidating.add(fid)
+        self.revalidator.submit(self.api.scheduler.in_background(self._revalidate_dir), rpath, fid)
+
+    def _revalidate_dir(self, rpath, fid):
+        try:
+            # (the lock isn't held while listing, so operations don't wait for it)
+            with self.lock:
+                moved = self.tree.path(fid) != rpath
+            if not moved:
+                self._refresh_local(rpath)
+            with self.lock:
+                self.listed_at[fid] = time.time()
+        except Exception as e:
+            dbg('Failed to refresh "{}": {}', rpath, e)
+        finally:
+            with self.lock:
+                self.revalidating.discard(fid)
+
+    def _track_changes(self):
+        # Poll the changes feed, and apply remote changes to the local state
+        dbg('Tracking remote changes every {} seconds', self.poll_interval)
+        last_save = time.time()
+        while not self.stop_tracking.wait(self.poll_interval):
+            try:
+                changes, token = self.api.list_changes(self.changes_token)
+                with self.lock:
+                    self._apply_changes(changes)
+                    self.changes_token = token
+                    if len(changes) != 0:
+                        self.index_dirty = True
+                self._fetch_deferred()
+            except Exception as e:
+                dbg('Failed to apply remote changes: {}', e)
+            if self.index_dirty and time.time()-last_save > SAVE_INTERVAL:
+                self._save_index()
+                last_save = time.time()
+
+    def _apply_changes(self, changes):
+        # Apply a batch of changes from the changes feed to the local state
+        if len(changes) != 0:
+            dbg('Applying {} remote changes', len(changes))
+        # Changes to files whose parents aren't cached yet are retried after the rest
+        # of the batch, in case the parent shows up later in the batch
+        while len(changes) != 0:
+            deferred = []
+            for change in changes:
+                if not self._apply_change(change):
+                    deferred.append(change)
+            if len(deferred) == len(changes):
+                break
+            changes = deferred
 
-    def _sync_remote(self, rpath):
+    def _apply_change(self, change):
+        # Apply a single change, and return False if it can't be applied yet
+        fid = change['fileId']
+        new_item = change.get('file')
+        old_item = self.id_to_item.get(fid)
+        if change['removed'] or new_item is None:
+            if old_item is not None:
+                self.api.forget(old_item[PARENTS][0], old_item[NAME])
+                self._remove_from_cache(old_item, self._get_cached_rpath(fid))
+            return True
+        if old_item is not None:
+            self.api.forget(old_item[PARENTS][0], old_item[NAME])
+        if fid == self.root_id or not new_item.get(PARENTS):
+            # nothing to do for the root, or files outside of My Drive
+            return True
+        self.api.forget(new_item[PARENTS][0], new_item[NAME])
+        new_rpath = self._get_local_rpath(new_item)
+        if new_rpath is None:
+            # the parent isn't cached (yet)
+            return False
+        if old_item is None:
+            # new file
+            self._cache(new_item, new_rpath, stub=True)
+            self._defer_fetch(fid)
+            return True
+        old_rpath = self._get_cached_rpath(fid)
+        if old_rpath != new_rpath:
+            dbg('File "{}" moved remotely', old_rpath)
+            self._update_in_hierarchy(old_rpath, old_item, new_item, new_rpath)
+        self.id_to_item[fid] = new_item
+        if new_item[MTYPE] != FOLDER_MTYPE and old_item[MTIME] < new_item[MTIME]:
+            lpath = self._lpath(new_rpath)
+            old_item = self.stale.get(fid, old_item)
+            if os.path.getmtime(lpath) != tstr_to_posix(old_item[MTIME]):
+                # TODO avoid losing work by creating a new file or something
+                dbg('File "{}" was modified both locally and remotely!', new_rpath)
+            else:
+                dbg('Locally cached copy of "{}" is stale!', new_rpath)
+                self._replace(old_item, lpath)
+        return True
+
+    def _queue_upload(self, fid):
+        # Queue a file for upload. Until a modified file has been uploaded, it's also recorded 
+        # in the index, so its changes are kept and uploaded by the next mount if this one 
+        # doesn't get to it (e.g. if it crashes). Must not be called with self.lock held.
+        with self.lock:
+            if self._modified(fid):
+                self._record_pending(fid)
+        self.uploads.enqueue(fid)
+
+    def _record_pending(self, fid):
+        rpath = self.tree.path(fid)
+        if rpath is not None and self.pending_uploads.get(fid) != rpath:
+            self.pending_uploads[fid] = rpath
+            self.index.save_pending(fid, rpath)
+
+    def _forget_pending(self, fid):
+        if self.pending_uploads.pop(fid, None) is not None:
+            self.index.remove_pending(fid)
+
+    def _upload(self, fid):
+        # Upload a queued file (this is what the upload workers run), and stop keeping track 
+        # of it once it's in sync. If it was written to meanwhile, it has been queued again.
+        self._sync_remote(fid)
+        with self.lock:
+            if not self._modified(fid):
+                self._forget_pending(fid)
+
+    def _sync_remote(self, fid):
         # Push local file data/attributes to the remote.
-        dbg('Syncing file "{}" with the remote'.format(rpath))
-        if not rpath in self.path_to_id:
-            err('Could not find file "{}" in internal metadata!'.format(rpath))
-        fid = self.path_to_id[rpath]
-        lpath = self._lpath(rpath)
+        # This runs on the upload workers, and uploads without holding self.lock.
+        dbg('Syncing file ID "{}" with the remote', fid)
+        with self._file_lock(fid):
+            with self.lock:
+                session = self._resumable_session(fid)
+            if session is not None:
+                uri, upload_path, snapshot_mtime = session
+                dbg('Resuming upload of file ID "{}"', fid)
+            else:
+                snapshot = self._snapshot(fid)
+                if snapshot is None:
+                    return
+                uri = None
+                upload_path, snapshot_mtime = snapshot
+                if upload_path is None:
+                    # only the mtime changed (e.g. by touch, or an editor saving identical 
+                    # contents), so there's no need to upload anything
+                    dbg('Contents of file ID "{}" are unchanged, only updating its mtime', fid)
+                    new_item = self.api.update(fid, {MTIME: posix_to_tstr(snapshot_mtime)})
+                    with self.lock:
+                        self._synced(fid, new_item, snapshot_mtime)
+                    return
+        def progress(session_uri, sent, total):
+            # remember the session of large uploads, so they can be continued if interrupted
+            with self.lock:
+                if self.upload_sessions.get(fid, (None,))[0] != session_uri:
+                    self.upload_sessions[fid] = (session_uri, upload_path, snapshot_mtime)
+                    self.index.save_upload(fid, session_uri, upload_path, snapshot_mtime)
+            self.uploads.report(fid, sent, total)
+        try:
+            with open(upload_path, 'rb') as f:
+                new_item = self.api.upload(f, fid, uri, progress)
+        except Exception:
+            with self.lock:
+                if not fid in self.upload_sessions:
+                    # there's nothing to resume, so the next attempt starts from a new snapshot
+                    os.remove(upload_path)
+            raise
+        with self._file_lock(fid), self.lock:
+            self._end_upload(fid)
+            os.remove(upload_path)
+            self._synced(fid, new_item, snapshot_mtime)
+        self._fetch_deferred()
+
+    def _synced(self, fid, new_item, snapshot_mtime):
+        # Update the local state after the snapshot of a file taken at 'snapshot_mtime' 
+        # has been pushed to the remote, which returned 'new_item'
+        if not fid in self.id_to_item:
+            return
+        old_item = self._version(fid)
+        self.id_to_item[fid] = new_item
+        self.index_dirty = True
+        lpath = self._lpath(self.tree.path(fid))
+        if fid in self.unfetched:
+            # this was resumed after a remount, and the placeholder is for the old version
+            self._replace(old_item, lpath)
+        elif os.path.getmtime(lpath) == snapshot_mtime:
+            # the local copy is now in sync with the remote, and can be evicted again
+            self.stale.pop(fid, None)
+            os.utime(lpath, (tstr_to_posix(new_item.get(ATIME)), tstr_to_posix(new_item.get(MTIME))))
+            if not fid in self.open_files:
+                # the remote metadata is accurate again
+                self.local_attrs.discard(fid)
+            self._account(fid, lpath)
+            self._evict()
+        # otherwise it was written to while uploading, and its mtime keeps it marked 
+        # as modified until it's uploaded again
+
+    def _snapshot(self, fid):
+        # Copy a modified file into the upload directory, and return the (path, mtime) of
+        # the copy, or None if there's nothing to upload. The path is None if only the 
+        # mtime was modified. Must be called with the file's lock held.
+        with self.lock:
+            if fid in self.unfetched or not fid in self.id_to_item:
+                # files are always fully fetched before they can be written to
+                return None
+            # (an open file that changed remotely is compared with the version it has)
+            local_item = self._version(fid)
+            cached_mtime = os.path.getmtime(self._lpath(self.tree.path(fid))) # mtime for the locally cached copy of the file
         '''
             first, check if the remote version is ahead of ours.
                 if so, we might not want to overwrite the remote
-            next, check if the cached copy has been modified more recently 
-                than our internal state says so. if so, push changes to the remote
+            next, check if the cached copy's mtime differs from the one
+                our internal state says it has. if so, push changes to the remote
         '''
-        remote_item = self.api.get_file(fid)
+        if self.poll_interval:
+            # the change tracker keeps the cached metadata up to date
+            remote_item = local_item
+        else:
+            remote_item = self.api.get_file(fid)
         remote_mtime = tstr_to_posix(remote_item[MTIME]) # mtime for the remote file
-        local_item = self.id_to_item[fid]
         local_mtime = tstr_to_posix(local_item[MTIME]) # mtime for the internally cached metadata
-        cached_mtime = os.path.getmtime(lpath) # mtime for the locally cached copy of the file
-        dbg('Remote MTime: {}, Local MTime: {}, Cached MTime: {}'.format(remote_mtime, local_mtime, cached_mtime))
+        dbg('Remote MTime: {}, Local MTime: {}, Cached MTime: {}', remote_mtime, local_mtime, cached_mtime)
         assert local_mtime >= remote_mtime, 'Remote copy fell behind locally cached metadata!'
         if remote_mtime > local_mtime:
             # the remote version is ahead of ours!
             dbg('Remote version is ahead of local version! The remote copy will be overwritten!')
             # TODO avoid losing work by creating a new file or something
-        if cached_mtime > local_mtime:
-             # the file has recently been written to, so push the changes to the remote
-             dbg('Pushing local changes to "{}" to the remote'.format(rpath))
-             new_item = self.api.upload(lpath, fid)
-             self.id_to_item[fid] = new_item
+        if cached_mtime == local_mtime:
+            # nothing to push
+            return None
+        # the file has recently been written to, so push the changes to the remote.
+        # Writers only wait for the snapshot to be taken, not for the upload.
+        dbg('Pushing local changes to file ID "{}" to the remote', fid)
+        with self.lock:
+            # the open file keeps working even if the file is moved while copying
+            lpath = self._lpath(self.tree.path(fid))
+            src = open(lpath, 'rb')
+        # keep the extension, which determines the uploaded mimetype
+        upload_path = os.path.join(self.upload_dir, fid+os.path.splitext(lpath)[1])
+        md5 = hashlib.md5()
+        with src, open(upload_path, 'wb') as dst:
+            snapshot_mtime = os.fstat(src.fileno()).st_mtime
+            while True:
+                buf = src.read(COPY_BUFSIZE)
+                if not buf:
+                    break
+                md5.update(buf)
+                dst.write(buf)
+        # Drive keeps the MD5 of the contents of regular files, which is the same as 
+        # that of the local copy until it's modified
+        if MD5 in local_item and md5.hexdigest() == local_item[MD5]:
+            os.remove(upload_path)
+            return None, snapshot_mtime
+        return upload_path, snapshot_mtime
+
+    def _resumable_session(self, fid):
+        # Returns the (session URI, snapshot path, snapshot mtime) of an interrupted upload
+        # of the file's current contents, or None
+        session = self.upload_sessions.get(fid)
+        if session is None:
+            return None
+        if fid in self.id_to_item and os.path.exists(session[1]):
+            lpath = self._lpath(self.tree.path(fid))
+            # after a remount, the modified local copy has been replaced with a placeholder
+            if fid in self.unfetched or os.path.getmtime(lpath) == session[2]:
+                return session
+        # the file was changed or removed since, so the upload has to start over
+        self._end_upload(fid)
+        if os.path.exists(session[1]):
+            os.remove(session[1])
+        return None
+
+    def _end_upload(self, fid):
+        # Forget the resumable upload session of a file
+        if self.upload_sessions.pop(fid, None) is not None:
+            self.index.remove_upload(fid)
+
+    def _init_uploads(self):
+        # Pick up the resumable uploads interrupted by the last mount, 
+        # and the modified files it didn't get to (see _queue_upload)
+        self.upload_sessions = self.index.load_uploads()
+        self.pending_uploads = self.index.load_pending()
+        snapshots = set(session[1] for session in self.upload_sessions.values())
+        if not os.path.exists(self.upload_dir):
+            os.makedirs(self.upload_dir)
+        for name in os.listdir(self.upload_dir):
+            path = os.path.join(self.upload_dir, name)
+            if not path in snapshots:
+                os.remove(path)
+        if len(self.upload_sessions) != 0:
+            dbg('Found {} interrupted uploads', len(self.upload_sessions))
 
     def _register_file(self, rpath, is_dir):
-        dbg('Registering new file at "{}"'.format(rpath))
+        # Create a new file on the remote, and add it to the local state. This is called
+        # with the lock of its directory held, and without self.lock, which is only taken
+        # once the remote has created it.
+        dbg('Registering new file at "{}"', rpath)
         beg = rpath.rindex('/')
-        parent = self._get_parent(rpath)
+        with self.lock:
+            parent = self._get_parent(rpath)
         # register new file
         name = rpath[beg+1:]
         in_trash = self._in_trash(rpath)
         item = self.api.create(name, parent, is_dir, in_trash)
         # keep local metadata consistent
-        fid = item[ID]
-        self.path_to_id[rpath] = fid
-        self.id_to_item[fid] = item
-        if is_dir:
-            self.id_to_children[fid] = []
-        self.id_to_children[parent].append(fid)
+        with self.lock:
+            if not parent in self.tree:
+                dbg('Parent of "{}" was removed while creating it', rpath)
+                return
+            # (its directory may have been moved meanwhile)
+            rpath = self.tree.path(parent).rstrip('/')+'/'+name
+            fid = item[ID]
+            self.tree.add(rpath, fid, is_dir)
+            self.id_to_item[fid] = item
+            if not is_dir:
+                self.local_attrs.add(fid)
+            if is_dir:
+                self.id_to_children[fid] = set()
+            self.id_to_children.setdefault(parent, set()).add(fid)
 
     def _remove_file(self, rpath):
-        fid = self.path_to_id[rpath]
-        item = self.id_to_item[fid]
-        lpath = self._lpath(rpath)
+        # Delete a file on the remote (or move it to the trash), and update the local state.
+        # Like _register_file, this is called with the lock of its directory held, and without self.lock.
+        with self.lock:
+            fid = self.tree.lookup(rpath)
+            item = self.id_to_item[fid]
+        self.api.forget(item[PARENTS][0], item[NAME])
         if item[TRASHED]:
             # Remove the file permanently
             self.api.delete(fid)
-            if item[MTYPE] == FOLDER_MTYPE:
-                os.rmdir(lpath)
-                del self.id_to_children[fid]
-            else:
-                os.remove(lpath)
-            del self.path_to_id[rpath]
-            del self.id_to_item[fid]
-            old_parent = item[PARENTS][0]
-            self.id_to_children[old_parent].remove(fid)
+            with self.lock:
+                if not fid in self.id_to_item:
+                    # the removal was already picked up from the remote
+                    return
+                lpath = self._lpath(self.tree.path(fid))
+                if item[MTYPE] == FOLDER_MTYPE:
+                    os.rmdir(lpath)
+                    del self.id_to_children[fid]
+                else:
+                    os.remove(lpath)
+                    self.unfetched.discard(fid)
+                    self.id_to_blocks.pop(fid, None)
+                    self.file_locks.pop(fid, None)
+                    self.quota.remove(fid)
+                    self.id_to_attrs.pop(fid, None)
+                    self.local_attrs.discard(fid)
+                    self.stale.pop(fid, None)
+                self.tree.remove(fid)
+                del self.id_to_item[fid]
+                old_parent = item[PARENTS][0]
+                self.id_to_children[old_parent].discard(fid)
         else:
             # Mark the file as trashed, and set its parent to the root to avoid directory hierachy confusion
             # TODO it would be great if this could be left as the original parent.
             # to do this, the trash directory logic would need to be changed
             old_parent = item[PARENTS][0]
-            if old_parent != self.root_id:
-                self.api.change_parent(fid, old_parent, self.root_id)
-                self.id_to_children[old_parent].remove(fid)
-                self.id_to_children[self.root_id].append(fid)
-            new_item = self.api.update(fid, {TRASHED: True})
-            # Fix up internal state
-            self.id_to_item[fid] = new_item
-            del self.path_to_id[rpath]
-            new_rpath = self.trash_dir+'/'+item[NAME]
-            new_lpath = self._lpath(new_rpath)
-            self.path_to_id[new_rpath] = fid
-            os.rename(lpath, new_lpath)
+            new_item = self.api.update(fid, {TRASHED: True}, old_parent, self.root_id)
+            with self.lock:
+                if not fid in self.id_to_item:
+                    return
+                if old_parent != self.root_id:
+                    self.id_to_children[old_parent].discard(fid)
+                    self.id_to_children.setdefault(self.root_id, set()).add(fid)
+                # Fix up internal state
+                self.id_to_item[fid] = new_item
+                lpath = self._lpath(self.tree.path(fid))
+                new_rpath = self.trash_dir+'/'+item[NAME]
+                new_lpath = self._lpath(new_rpath)
+                self.tree.move(fid, new_rpath)
+                os.rename(lpath, new_lpath)
 
     def _init_tmp(self):
         dbg('Initializing temporary directory')
-        if os.path.exists(self.tmp_dir):
-            err('"{}" already exists! Remove it or rename it to continue.'.format(self.tmp_dir))
+        # Only one mount can use the cache directory at a time
+        self.tmp_lock = open(self.tmp_dir+'.lock', 'w')
+        try:
+            fcntl.flock(self.tmp_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            err('"{}" is in use by another mount!'.format(self.tmp_dir))
+        # drop any downloads interrupted by the last mount
+        if os.path.exists(self.download_dir):
+            shutil.rmtree(self.download_dir)
+        os.makedirs(self.download_dir)
+
+    def _reset_tmp(self):
+        # Start over with an empty temporary directory
+        self._cleanup_tmp()
         os.makedirs(self.tmp_dir)
         os.makedirs(self.tmp_dir+self.trash_dir)
 
@@ -357,14 +1402,11 @@ class DriveFS(Operations):
         else:
             # find parent ID from cached metadata
             parent_path = rpath[:beg]
-            if not parent_path in self.path_to_id:
-                dbg('Failed to find parent "{}" in cached metadata!'.format(parent_path))
+            parent = self.tree.lookup(parent_path)
+            if parent is None:
+                dbg('Failed to find parent "{}" in cached metadata!', parent_path)
                 raise FuseOSError(errno.ENOENT)
-            return self.path_to_id[parent_path]
-
-    def _rpath(self, lpath):
-        # Return the remote filepath from the local path
-        return lpath[len(self.tmp_dir):]
+            return parent
 
     def _lpath(self, rpath):
         # Return the local filepath from the remote path
@@ -372,13 +1414,35 @@ class DriveFS(Operations):
 
     ''' Filesystem methods '''
 
+    def init(self, path):
+        dbg('init: {}', path)
+        # Threads have to be started here, since FUSE forks after the constructor runs
+        threading.Thread(target=self._start, daemon=True).start()
+
     def destroy(self, path):
-        dbg('destroy: {}'.format(path))
-        self._cleanup_tmp()
-        # call _sync_remote on every file
+        dbg('destroy: {}', path)
+        self.stop_tracking.set()
+        self.revalidator.shutdown(wait=False)
+        self.prefetcher.stop()
+        # don't unmount before local changes have made it to the remote
+        if len(self.uploads) != 0:
+            dbg('Waiting for {} uploads to finish...', len(self.uploads))
+        self.uploads.stop()
+        if self.poll_interval:
+            # keep the local copies around for the next mount (unless they were never loaded)
+            if self.start_error is None:
+                self._save_index()
+        else:
+            # except for the changes that failed to upload
+            self._set_aside_pending()
+            self._cleanup_tmp()
+        self.tmp_lock.close()
+        if self.stats_dump is not None:
+            with open(self.stats_dump, 'w') as f:
+                f.write(self.metrics.to_prometheus() if self.stats_dump.endswith('.prom') else self.metrics.to_json())
 
     def access(self, path, mode):
-        dbg('access: {}'.format(path))
+        dbg('access: {}', path)
         lpath = self._lpath(path)
         if not os.access(lpath, mode):
             # if file doesn't exist locally, refresh and try again
@@ -387,38 +1451,71 @@ class DriveFS(Operations):
                 raise FuseOSError(errno.ENOENT)
 
     def chmod(self, path, mode):
-        dbg('chmod: {}'.format(path))
-        lpath = self._lpath(path)
+        dbg('chmod: {}', path)
         lpath = self._lpath(path)
+        self._attrs_changed(path)
         return os.chmod(lpath, mode)
 
     def chown(self, path, uid, gid):
-        dbg('chown: {}'.format(path))
+        dbg('chown: {}', path)
         lpath = self._lpath(path)
+        self._attrs_changed(path)
         return os.chown(lpath, uid, gid)
 
     def getattr(self, path, fh=None):
-        dbg('getattr: {}'.format(path))
+        dbg('getattr: {}', path)
+        fid = self.tree.lookup(path)
+        if fid is None:
+            raise FuseOSError(errno.ENOENT)
+        if fid in self.id_to_item and not fid in self.local_attrs:
+            # answer from the Drive metadata, without touching the local copy
+            attrs = self._attrs(fid)
+            if attrs is not None:
+                return attrs
         lpath = self._lpath(path)
         if not os.path.exists(lpath):
             raise FuseOSError(errno.ENOENT)
         st = os.lstat(lpath)
-        return dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
+        attrs = dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
                      'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid', 'st_blocks'))
+        attrs['st_ino'] = inode(fid)
+        return attrs
+
+    def opendir(self, path):
+        dbg('opendir: {}', path)
+        fid = self.tree.lookup(path)
+        if fid is None:
+            raise FuseOSError(errno.ENOENT)
+        fh = next(self.dir_handle_ids)
+        self.dir_handles[fh] = fid
+        return fh
 
     def readdir(self, path, fh):
-        dbg('readdir: {}'.format(path))
+        dbg('readdir: {}', path)
         dirents = ['.', '..']
-        # reads should be consistent
-        self._refresh_local(path)
-        lpath = self._lpath(path)
-        if os.path.isdir(lpath):
-            dirents.extend(os.listdir(lpath))
-        for r in dirents:
-            yield r
+        fid = self.dir_handles.get(fh) or self.tree.lookup(path)
+        if fid is None or not self.tree.is_dir(fid):
+            return dirents
+        # opening its files after this might be a scan
+        self.prefetcher.listed(fid)
+        if not self.poll_interval:
+            # reads should be (eventually) consistent
+            if time.time()-self.listed_at.get(fid, self.mounted_at) > self.attr_timeout:
+                self._revalidate(self.tree.path(fid), fid)
+        # The entries come with their inode numbers and types, 
+        # so listing them doesn't take a getattr for each one
+        for name, child in self.tree.entries(fid):
+            mode = DIR_MODE if self.tree.is_dir(child) else FILE_MODE
+            dirents.append((name, {'st_ino': inode(child), 'st_mode': mode}, 0))
+        return dirents
+
+    def releasedir(self, path, fh):
+        dbg('releasedir: {}', path)
+        self.dir_handles.pop(fh, None)
+        return 0
 
     def readlink(self, path):
-        dbg('readlink: {}'.format(path))
+        dbg('readlink: {}', path)
         lpath = self._lpath(path)
         pathname = os.readlink(lpath)
         if pathname.startswith("/"):
@@ -428,73 +1525,106 @@ class DriveFS(Operations):
             return pathname
 
     def mknod(self, path, mode, dev):
-        dbg('mknod: {}'.format(path))
+        dbg('mknod: {}', path)
         if dev != 0:
             # Don't support creating special device files
             raise FuseOSError(errno.ENOSYS)
         lpath = self._lpath(path)
-        # Make the locally cached copy, which will handle any errors (dirnoent, already exists, etc.)
-        os.mknod(lpath, mode, dev)
-        # Register the file with the remote
-        self._register_file(path, False)
+        with self._locked_dirs(os.path.dirname(path)):
+            # Make the locally cached copy, which will handle any errors (dirnoent, already exists, etc.)
+            with self.lock:
+                os.mknod(lpath, mode, dev)
+            # Register the file with the remote
+            self._register_file(path, False)
 
     def rmdir(self, path):
-        dbg('rmdir: {}'.format(path))
+        dbg('rmdir: {}', path)
         lpath = self._lpath(path)
-        if not os.path.isdir(lpath):
-            raise FuseOSError(errno.ENOTDIR)
-        if len(os.listdir(lpath)) != 0:
-            raise FuseOSError(errno.ENOTEMPTY)
-        self._remove_file(path)
+        # (its own lock too, so nothing gets created in it meanwhile)
+        with self._locked_dirs(os.path.dirname(path), path):
+            with self.lock:
+                if not os.path.isdir(lpath):
+                    raise FuseOSError(errno.ENOTDIR)
+                if len(os.listdir(lpath)) != 0:
+                    raise FuseOSError(errno.ENOTEMPTY)
+            self._remove_file(path)
 
     def unlink(self, path):
-        dbg('unlink: {}'.format(path))
+        dbg('unlink: {}', path)
         # Since links aren't supported, assume there's only one link to this file
         lpath = self._lpath(path)
-        if not os.path.exists(lpath):
-            raise FuseOSError(errno.ENOENT)
         if path == self.trash_dir:
-            raise FuseOsError(errno.EINVAL)
-        self._remove_file(path)
+            raise FuseOSError(errno.EINVAL)
+        with self._locked_dirs(os.path.dirname(path)):
+            if not os.path.exists(lpath):
+                raise FuseOSError(errno.ENOENT)
+            self._remove_file(path)
 
     def rename(self, old_path, new_path):
-        dbg('rename: {} to {}'.format(old_path, new_path))
-        if not old_path in self.path_to_id:
-            raise FuseOSError(errno.ENOENT)
-        if os.path.exists(new_path):
-            raise FuseOSError(errno.EEXIST)
+        dbg('rename: {} to {}', old_path, new_path)
         if old_path == '/':
             raise FuseOSError(errno.ENOSYS)
-        name = new_path[new_path.rfind('/')+1:]
-        fid = self.path_to_id[old_path]
-        old_item = self.id_to_item[fid]
-        new_parent = self._get_parent(new_path)
-        new_item = self.api.change_parent(fid, old_item[PARENTS][0], new_parent)
-        new_item = self.api.update(fid, {NAME: name})
-        self._update_in_hierarchy(old_path, old_item, new_item)
+        with self.lock:
+            # (a directory that gets replaced is locked too, like by rmdir)
+            dirs = [os.path.dirname(old_path), os.path.dirname(new_path)]
+            if self.tree.is_dir(self.tree.lookup(new_path)):
+                dirs.append(new_path)
+        with self._locked_dirs(*dirs):
+            with self.lock:
+                fid = self.tree.lookup(old_path)
+                if fid is None:
+                    raise FuseOSError(errno.ENOENT)
+                target = self.tree.lookup(new_path)
+                if target == fid:
+                    return
+                if target is not None:
+                    # Like rename(2), this replaces an existing file (which is how editors 
+                    # and git save files atomically), or an empty directory with a directory
+                    if self.tree.is_dir(target):
+                        if not self.tree.is_dir(fid):
+                            raise FuseOSError(errno.EISDIR)
+                        if len(self.tree.entries(target)) != 0:
+                            raise FuseOSError(errno.ENOTEMPTY)
+                    elif self.tree.is_dir(fid):
+                        raise FuseOSError(errno.ENOTDIR)
+                name = new_path[new_path.rfind('/')+1:]
+                old_item = self.id_to_item[fid]
+                new_parent = self._get_parent(new_path)
+            if target is not None:
+                # the replaced file goes to the trash, just like when it's unlinked
+                self._remove_file(new_path)
+            new_item = self.api.update(fid, {NAME: name}, old_item[PARENTS][0], new_parent)
+            self.api.forget(old_item[PARENTS][0], old_item[NAME])
+            self.api.forget(new_parent, name)
+            with self.lock:
+                if fid in self.id_to_item:
+                    self._update_in_hierarchy(self.tree.path(fid), self.id_to_item[fid], new_item, new_path)
 
     def utimens(self, path, times):
-        dbg('utime: {} to {}'.format(path, times))
+        dbg('utime: {} to {}', path, times)
         lpath = self._lpath(path)
+        self._attrs_changed(path)
         os.utime(lpath, times)
 
     def symlink(self, path, new_path):
-        dbg('symlink: {} to {}'.format(path, new_path))
+        dbg('symlink: {} to {}', path, new_path)
         raise FuseOSError(errno.ENOSYS)
 
     def link(self, path, new_path):
-        dbg('link: {} to {}'.format(path, new_path))
+        dbg('link: {} to {}', path, new_path)
         raise FuseOSError(errno.ENOSYS)
 
     def mkdir(self, path, mode):
-        dbg('mkdir: {}'.format(path))
-        # Make the locally cached copy, which will handle any errors (dirnoent, already exists, etc.)
-        os.mkdir(self._lpath(path), mode)
-        # Register the file with the remote
-        self._register_file(path, True)
+        dbg('mkdir: {}', path)
+        with self._locked_dirs(os.path.dirname(path)):
+            # Make the locally cached copy, which will handle any errors (dirnoent, already exists, etc.)
+            with self.lock:
+                os.mkdir(self._lpath(path), mode)
+            # Register the file with the remote
+            self._register_file(path, True)
 
     def statfs(self, path):
-        dbg('statfs: {}'.format(path))
+        dbg('statfs: {}', path)
         lpath = self._lpath(path)
         stv = os.statvfs(lpath)
         return dict((key, getattr(stv, key)) for key in ('f_bavail', 'f_bfree',
@@ -503,53 +1633,219 @@ class DriveFS(Operations):
 
     ''' File methods '''
     def open(self, path, flags):
-        dbg('open: {}'.format(path))
-        lpath = self._lpath(path)
-        return os.open(lpath, flags)
+        dbg('open: {}', path)
+        with self.lock:
+            fid = self.tree.lookup(path)
+            # sparse copies are filled in by read(), unless the file is going to be written
+            fetch = fid in self.unfetched and (flags & (os.O_WRONLY | os.O_RDWR) or not fid in self.id_to_blocks)
+            # open files can't be evicted
+            self._opened(fid)
+            if flags & (os.O_WRONLY | os.O_RDWR) and fid in self.id_to_item:
+                self.local_attrs.add(fid)
+            prefetch = self._scan_prefetch(fid, os.path.basename(path)) if fid in self.id_to_item else []
+            if fetch or not fid in self.id_to_blocks:
+                # (reads of sparse copies are counted block by block)
+                self.metrics.count('cache_misses' if fetch else 'cache_hits', cache='contents')
+        # the rest of the directory is fetched while this file is
+        self.metrics.count('prefetched_files', len(prefetch))
+        self.prefetcher.prefetch(prefetch)
+        try:
+            if fetch:
+                self._fetch(fid)
+            with self.lock:
+                self.quota.touch(fid)
+                fh = os.open(self._lpath(path), flags)
+                self.handles[fh] = fid
+                return fh
+        except:
+            with self.lock:
+                self._closed(fid)
+            raise
 
     def create(self, path, mode, fi=None):
-        dbg('create: {}'.format(path))
+        dbg('create: {}', path)
         lpath = self._lpath(path)
-        if not os.path.exists(lpath):
-            # If creating a new file, register it
-            self._register_file(path, False)
-        return os.open(lpath, os.O_WRONLY | os.O_CREAT, mode)
+        with self._locked_dirs(os.path.dirname(path)):
+            if not os.path.exists(lpath):
+                # If creating a new file, register it
+                self._register_file(path, False)
+            with self.lock:
+                fh = os.open(lpath, os.O_WRONLY | os.O_CREAT, mode)
+                fid = self.tree.lookup(path)
+                self._opened(fid)
+                self.handles[fh] = fid
+        return fh
 
     def read(self, path, length, offset, fh):
-        dbg('read: {}'.format(path))
-        os.lseek(fh, offset, os.SEEK_SET)
-        return os.read(fh, length)
+        dbg('read: {}', path)
+        fid = self.handles[fh]
+        with self.lock:
+            blocks = self.id_to_blocks.get(fid)
+            self.quota.touch(fid)
+        if blocks is not None:
+            with self._file_lock(fid):
+                # fetch the requested range, plus some extra for sequential readers
+                readahead = blocks.readahead(offset, length)
+                hit = len(blocks.missing(offset, offset+length)) == 0
+                self.metrics.count('cache_hits' if hit else 'cache_misses', cache='blocks')
+                if self.prefetcher.enabled():
+                    # the extra is fetched in the background, while this is being returned
+                    self._fetch_range(fid, offset, offset+length)
+                    self.prefetcher.readahead(fid, offset+length, min(offset+length+readahead, blocks.size))
+                else:
+                    self._fetch_range(fid, offset, offset+length+readahead)
+        # positional I/O, since other threads may be using the same handle
+        return os.pread(fh, length, offset)
 
     def write(self, path, buf, offset, fh):
-        dbg('write: {}'.format(path))
-        return os.write(fh, buf)
+        dbg('write: {}', path)
+        return os.pwrite(fh, buf, offset)
 
     def truncate(self, path, length, fh=None):
-        dbg('truncate: {}'.format(path))
-        lpath = self._lpath(path)
-        with open(lpath, 'r+') as f:
-            f.truncate(length)
-        self._sync_remote(path)
+        dbg('truncate: {}', path)
+        with self.lock:
+            fid = self.handles[fh] if fh is not None else self.tree.lookup(path)
+        if fid is None:
+            raise FuseOSError(errno.ENOENT)
+        with self._file_lock(fid):
+            if length == 0:
+                # the old contents don't matter
+                with self.lock:
+                    self.unfetched.discard(fid)
+                    self.id_to_blocks.pop(fid, None)
+            else:
+                self._fetch(fid)
+            with self.lock:
+                lpath = self._lpath(self.tree.path(fid))
+                os.truncate(lpath, length)
+                self._account(fid, lpath)
+                self.local_attrs.add(fid)
+                # open files are uploaded when they're flushed, so half-written 
+                # contents don't get uploaded
+                sync = not fid in self.open_files
+        if sync:
+            self._queue_upload(fid)
 
     def flush(self, path, fh):
-        dbg('flush: {}'.format(path))
+        dbg('flush: {}', path)
+        # only wait for the local copy, the upload happens in the background
         os.fsync(fh)
-        self._sync_remote(path)
+        self._queue_upload(self.handles[fh])
 
     def release(self, path, fh):
-        dbg('release: {}'.format(path))
-        self.flush(path, fh)
-        os.close(fh)
+        dbg('release: {}', path)
+        with self.lock:
+            # (before closing it, since the descriptor can be reused by another open right after)
+            fid = self.handles.pop(fh)
+            os.close(fh)
+            self._closed(fid)
+            if not fid in self.tree:
+                # the file was removed while it was open
+                return
+            lpath = self._lpath(self.tree.path(fid))
+            if fid in self.stale and not fid in self.open_files:
+                # it changed remotely while it was open
+                old_item = self.stale.pop(fid)
+                if os.path.getmtime(lpath) == tstr_to_posix(old_item[MTIME]):
+                    dbg('Replacing stale local copy of file ID "{}"', fid)
+                    self._store(self.id_to_item[fid], lpath, stub=True)
+                    self._defer_fetch(fid)
+                else:
+                    # TODO avoid losing work by creating a new file or something
+                    dbg('File ID "{}" was modified both locally and remotely!', fid)
+            if not fid in self.unfetched or fid in self.id_to_blocks:
+                # writes may have changed its size
+                self._account(fid, lpath)
+        self._fetch_deferred()
+        # catch any writes since the last flush
+        self._queue_upload(fid)
 
     def fsync(self, path, fdatasync, fh):
-        dbg('fsync: {}'.format(path))
+        dbg('fsync: {}', path)
         self.flush(path, fh)
 
-def main(mountpoint):
-    FUSE(DriveFS(), mountpoint, nothreads=True, foreground=False)
+def main(mountpoint, lazy=True, chunk_size=DOWNLOAD_CHUNK_SIZE, crawl_workers=CRAWL_WORKERS, 
+         poll_interval=POLL_INTERVAL, fresh=False, dentry_ttl=DENTRY_TTL, nothreads=False,
+         upload_workers=UPLOAD_WORKERS, upload_chunk_size=UPLOAD_CHUNK_SIZE,
+         cache_dir=CONFIG_DIR, cache_size=0, cache_files=0, attr_timeout=ATTR_TIMEOUT, 
+         entry_timeout=ENTRY_TIMEOUT, transport='pooled', pool_size=POOL_SIZE, endpoint=None,
+         rate_limit=RATE_LIMIT, prefetch_workers=PREFETCH_WORKERS, prefetch_size=PREFETCH_SIZE,
+         prefetch_files=PREFETCH_FILES, stats_dump=None, export_cache_size=EXPORT_CACHE_SIZE):
+    fs = DriveFS(lazy=lazy, chunk_size=chunk_size, crawl_workers=crawl_workers, 
+                 poll_interval=poll_interval, fresh=fresh, dentry_ttl=dentry_ttl,
+                 upload_workers=upload_workers, upload_chunk_size=upload_chunk_size,
+                 cache_dir=cache_dir, cache_size=cache_size, cache_files=cache_files, 
+                 attr_timeout=attr_timeout, transport=transport, pool_size=pool_size, endpoint=endpoint,
+                 rate_limit=rate_limit, prefetch_workers=prefetch_workers, prefetch_size=prefetch_size,
+                 prefetch_files=prefetch_files, stats_dump=stats_dump, export_cache_size=export_cache_size)
+    # the kernel uses the inode numbers reported by getattr and readdir
+    FUSE(fs, mountpoint, nothreads=nothreads, foreground=False, use_ino=True,
+         attr_timeout=attr_timeout, entry_timeout=entry_timeout)
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        err('Not enough arguments! usage: `./drivefs.py <mount-point>`')
-    main(sys.argv[1])
+    parser = argparse.ArgumentParser(description='Mount Google Drive as a FUSE filesystem.')
+    parser.add_argument('mountpoint')
+    parser.add_argument('--eager', action='store_true', 
+                        help='download all file contents at mount time instead of on first open')
+    parser.add_argument('--chunk-size', type=int, default=DOWNLOAD_CHUNK_SIZE,
+                        help='number of bytes downloaded per request when fetching whole files')
+    parser.add_argument('--crawl-workers', type=int, default=CRAWL_WORKERS,
+                        help='number of folders listed concurrently at mount time')
+    parser.add_argument('--poll-interval', type=float, default=POLL_INTERVAL,
+                        help='seconds between checks for remote changes (0 re-lists directories on every read instead)')
+    parser.add_argument('--fresh', action='store_true',
+                        help='ignore the metadata and contents cached by previous mounts')
+    parser.add_argument('--dentry-ttl', type=float, default=DENTRY_TTL,
+                        help='seconds that remote lookups of uncached paths (including misses) are cached for')
+    parser.add_argument('--single-threaded', action='store_true',
+                        help='handle one filesystem operation at a time')
+    parser.add_argument('--upload-workers', type=int, default=UPLOAD_WORKERS,
+                        help='number of files uploaded concurrently in the background')
+    parser.add_argument('--upload-chunk-size', type=int, default=UPLOAD_CHUNK_SIZE,
+                        help='files larger than this many bytes are uploaded in resumable chunks of this size '
+                             '(a multiple of 256 KiB)')
+    parser.add_argument('--cache-dir', default=CONFIG_DIR,
+                        help='directory that file contents and metadata are cached in')
+    parser.add_argument('--cache-size', type=int, default=0,
+                        help='maximum number of bytes of file contents cached locally (0 for no limit)')
+    parser.add_argument('--cache-files', type=int, default=0,
+                        help='maximum number of files whose contents are cached locally (0 for no limit)')
+    parser.add_argument('--export-cache-size', type=int, default=EXPORT_CACHE_SIZE,
+                        help='maximum number of bytes of exported Workspace documents kept between mounts '
+                             '(0 for no limit)')
+    parser.add_argument('--attr-timeout', type=float, default=ATTR_TIMEOUT,
+                        help='seconds that file attributes are cached by the kernel '
+                             '(and directory listings, with --poll-interval 0)')
+    parser.add_argument('--entry-timeout', type=float, default=ENTRY_TIMEOUT,
+                        help='seconds that name lookups are cached by the kernel')
+    parser.add_argument('--transport', choices=sorted(TRANSPORTS), default='pooled',
+                        help='how connections to the Drive API are managed')
+    parser.add_argument('--pool-size', type=int, default=POOL_SIZE,
+                        help='maximum number of connections kept open to the Drive API')
+    parser.add_argument('--endpoint',
+                        help='root URL of another server implementing the Drive API (without authentication), '
+                             'e.g. a fake one for testing')
+    parser.add_argument('--rate-limit', type=float, default=RATE_LIMIT,
+                        help='maximum number of requests per second sent to the Drive API (0 for no limit), '
+                             'which is lowered temporarily when throttled')
+    parser.add_argument('--prefetch-workers', type=int, default=PREFETCH_WORKERS,
+                        help='number of files (or read-ahead ranges) fetched concurrently ahead of being read '
+                             '(0 to only fetch what is read)')
+    parser.add_argument('--prefetch-size', type=int, default=PREFETCH_SIZE,
+                        help='maximum size in bytes of the files prefetched when a directory is scanned')
+    parser.add_argument('--prefetch-files', type=int, default=PREFETCH_FILES,
+                        help='maximum number of files prefetched when a directory is scanned')
+    parser.add_argument('--stats-dump', metavar='PATH',
+                        help='write the metrics of the mount to this file when unmounting '
+                             '(in Prometheus format if it ends with .prom, JSON otherwise)')
+    args = parser.parse_args()
+    main(args.mountpoint, lazy=not args.eager, chunk_size=args.chunk_size, 
+         crawl_workers=args.crawl_workers, poll_interval=args.poll_interval, fresh=args.fresh,
+         dentry_ttl=args.dentry_ttl, nothreads=args.single_threaded, 
+         upload_workers=args.upload_workers, upload_chunk_size=args.upload_chunk_size,
+         cache_dir=args.cache_dir, cache_size=args.cache_size, cache_files=args.cache_files,
+         attr_timeout=args.attr_timeout, entry_timeout=args.entry_timeout, transport=args.transport,
+         pool_size=args.pool_size, endpoint=args.endpoint, rate_limit=args.rate_limit,
+         prefetch_workers=args.prefetch_workers, prefetch_size=args.prefetch_size, 
+         prefetch_files=args.prefetch_files, stats_dump=args.stats_dump, export_cache_size=args.export_cache_size)
 
@@ -0,0 +1,95 @@
+from utils import *
+from quota import CacheQuota
+
+import os
+import shutil
+import tempfile
+import threading
+
+EXPORT_CACHE_SIZE = 256*(1 << 20) # bytes of exported documents kept between mounts (0 for no limit)
+# Bytes reported for documents until their current version has been exported: Drive's limit
+# on the size of exports, so it's never too small (which would cut reads short)
+EXPORT_SIZE = 10 << 20
+
+class ExportCache():
+    # Keeps the exports of Google Workspace documents on disk, so each version of a document
+    # is only exported once, even if its local copy is evicted or the metadata index is rebuilt.
+    # Exports are stored as <path>/<target mimetype>/<file ID>@<modifiedTime>, keeping only the
+    # latest version of each document, and the least recently used ones are removed once
+    # they take up more than 'max_bytes'.
+    def __init__(self, path, max_bytes=EXPORT_CACHE_SIZE):
+        self.path = path
+        self.lock = threading.Lock()
+        # maps (mimetype, file ID) to the (modifiedTime, size) of the cached export
+        self.exports = dict()
+        self.quota = CacheQuota(max_bytes)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        # The last time an export was used is the mtime of its file
+        found = []
+        for mimetype_dir in os.listdir(path):
+            mimetype = mimetype_dir.replace('_', '/', 1)
+            for name in os.listdir(os.path.join(path, mimetype_dir)):
+                export_path = os.path.join(path, mimetype_dir, name)
+                if not '@' in name:
+                    # left behind by an interrupted copy
+                    os.remove(export_path)
+                    continue
+                fid, mtime = name.split('@', 1)
+                st = os.stat(export_path)
+                found.append((st.st_mtime, (mimetype, fid), mtime, st.st_size))
+        for _, key, mtime, size in sorted(found):
+            self.exports[key] = (mtime, size)
+            self.quota.touch(key, size)
+        dbg('Found {} cached exports', len(self.exports))
+
+    def __len__(self):
+        return len(self.exports)
+
+    def _path(self, mimetype, fid, mtime):
+        return os.path.join(self.path, mimetype.replace('/', '_'), '{}@{}'.format(fid, mtime))
+
+    def size(self, fid, mtime, mimetype):
+        # Returns the size of the export of version 'mtime' of a document to 'mimetype', or None
+        with self.lock:
+            export = self.exports.get((mimetype, fid))
+        return export[1] if export is not None and export[0] == mtime else None
+
+    def get(self, fid, mtime, mimetype, dest):
+        # Copy the export of version 'mtime' of a document to 'dest', if it's cached.
+        # Returns whether it was.
+        key = (mimetype, fid)
+        with self.lock:
+            if self.exports.get(key, (None,))[0] != mtime:
+                return False
+            path = self._path(mimetype, fid, mtime)
+            os.utime(path)
+            self.quota.touch(key)
+            # (a copy, so writes to the local copy can't change the cached export)
+            shutil.copyfile(path, dest)
+        return True
+
+    def put(self, fid, mtime, mimetype, src):
+        # Cache a copy of 'src' as the export of version 'mtime' of a document,
+        # replacing any other version
+        key = (mimetype, fid)
+        path = self._path(mimetype, fid, mtime)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        os.close(fd)
+        shutil.copyfile(src, tmp_path)
+        size = os.path.getsize(tmp_path)
+        with self.lock:
+            old = self.exports.get(key)
+            if old is not None and old[0] != mtime:
+                os.remove(self._path(mimetype, fid, old[0]))
+            os.replace(tmp_path, path)
+            self.exports[key] = (mtime, size)
+            self.quota.touch(key, size)
+            for old_key in self.quota.lru():
+                if not self.quota.over():
+                    break
+                if old_key != key:
+                    dbg('Evicting cached export of file ID "{}"', old_key[1])
+                    os.remove(self._path(old_key[0], old_key[1], self.exports.pop(old_key)[0]))
+                    self.quota.remove(old_key)
@@ -0,0 +1,77 @@
+from utils import *
+
+import sqlite3
+import json
+import threading
+
+# How much of a file's contents is present in the local cache
+STUB = 0 # none, the local copy is a placeholder
+PARTIAL = 1 # some blocks, as recorded in the block bitmap
+FETCHED = 2 # all of it
+
+class MetadataIndex():
+    # Persists the cached Drive metadata (and the state of the local copies) between mounts
+    def __init__(self, path):
+        dbg('Opening metadata index at "{}"', path)
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS items '
+                            '(id TEXT PRIMARY KEY, item TEXT, rpath TEXT, content INTEGER, blocks BLOB)')
+            # Resumable uploads in progress, which are kept up to date as they happen
+            # (rather than with the snapshots above), so they survive a crash
+            self.db.execute('CREATE TABLE IF NOT EXISTS uploads '
+                            '(id TEXT PRIMARY KEY, session TEXT, path TEXT, mtime REAL)')
+            # Modified files that haven't been uploaded yet, by the path of their local copy,
+            # which are kept (and queued again) by the next mount if this one doesn't get to them
+            self.db.execute('CREATE TABLE IF NOT EXISTS pending (id TEXT PRIMARY KEY, rpath TEXT)')
+
+    def load_state(self):
+        with self.lock:
+            return dict(self.db.execute('SELECT key, value FROM state'))
+
+    def load_items(self):
+        # Returns a list of (item, rpath, content, blocks) tuples
+        with self.lock:
+            rows = self.db.execute('SELECT item, rpath, content, blocks FROM items').fetchall()
+        return [(json.loads(item), rpath, content, blocks) for item, rpath, content, blocks in rows]
+
+    def save(self, state, rows):
+        # Replace the index with a snapshot of the local state.
+        # 'rows' is a list of (fid, item, rpath, content, blocks) tuples.
+        dbg('Saving {} items to the metadata index', len(rows))
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM state')
+            self.db.executemany('INSERT INTO state VALUES (?, ?)', state.items())
+            self.db.execute('DELETE FROM items')
+            self.db.executemany('INSERT INTO items VALUES (?, ?, ?, ?, ?)',
+                ((fid, json.dumps(item), rpath, content, blocks) for fid, item, rpath, content, blocks in rows))
+
+    def load_uploads(self):
+        # Returns a dict of file ID -> (session URI, snapshot path, snapshot mtime)
+        with self.lock:
+            rows = self.db.execute('SELECT id, session, path, mtime FROM uploads').fetchall()
+        return dict((fid, (session, path, mtime)) for fid, session, path, mtime in rows)
+
+    def save_upload(self, fid, session, path, mtime):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?)', (fid, session, path, mtime))
+
+    def remove_upload(self, fid):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM uploads WHERE id = ?', (fid,))
+
+    def load_pending(self):
+        # Returns a dict of file ID -> remote path
+        with self.lock:
+            return dict(self.db.execute('SELECT id, rpath FROM pending'))
+
+    def save_pending(self, fid, rpath):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO pending VALUES (?, ?)', (fid, rpath))
+
+    def remove_pending(self, fid):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM pending WHERE id = ?', (fid,))
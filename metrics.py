@@ -0,0 +1,136 @@
+from utils import *
+
+import bisect
+import json
+import math
+import threading
+
+# Upper bounds (in seconds) of the buckets latencies are counted in
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, math.inf)
+PREFIX = 'drivefs_' # prefix of the names of exported metrics
+
+def key_str(name, labels):
+    # Formats a metric name and its labels like Prometheus does, e.g. 'name{op="read"}'
+    if not labels:
+        return name
+    return '{}{{{}}}'.format(name, ','.join('{}="{}"'.format(k, v) for k, v in labels))
+
+class Histogram():
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0]*len(buckets) # not cumulative
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def state(self):
+        # Returns a consistent copy of the counts, the count, the sum and the maximum
+        with self.lock:
+            return list(self.counts), self.count, self.sum, self.max
+
+    def quantile(self, q, state=None):
+        # Returns the upper bound of the bucket the 'q' quantile falls in
+        counts, total, _, maximum = state or self.state()
+        rank = q*total
+        seen = 0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= rank and seen != 0:
+                return min(bound, maximum)
+        return 0
+
+class Metrics():
+    # Counters, histograms and gauges describing what a mount is doing.
+    # Metrics are identified by a name and optional labels, like Prometheus metrics.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict() # maps (name, labels) to numbers
+        self.histograms = dict() # maps (name, labels) to Histograms
+        self.gauges = dict() # maps names to functions returning their current value
+
+    def count(self, name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())) if labels else ())
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0)+n
+
+    def histogram(self, name, **labels):
+        # Returns the histogram of a metric, which hot paths can hold on to and
+        # observe values in directly, without looking it up every time
+        key = (name, tuple(sorted(labels.items())) if labels else ())
+        with self.lock:
+            if not key in self.histograms:
+                self.histograms[key] = Histogram()
+            return self.histograms[key]
+
+    def observe(self, name, value, **labels):
+        self.histogram(name, **labels).observe(value)
+
+    def gauge(self, name, fn):
+        # Register a gauge, whose value is read from fn() whenever the metrics are read
+        self.gauges[name] = fn
+
+    def snapshot(self):
+        # Returns all metrics as a JSON-serializable dict
+        with self.lock:
+            counters = dict((key_str(*key), value) for key, value in sorted(self.counters.items()))
+            registered = sorted(self.histograms.items())
+        histograms = dict()
+        for key, histogram in registered:
+            state = histogram.state()
+            counts, count, total, maximum = state
+            histograms[key_str(*key)] = dict(count=count, sum=total, max=maximum,
+                p50=histogram.quantile(0.5, state), p90=histogram.quantile(0.9, state), 
+                p99=histogram.quantile(0.99, state),
+                buckets=dict((str(b), c) for b, c in zip(histogram.buckets, counts) if c != 0))
+        return dict(counters=counters, histograms=histograms, gauges=self._read_gauges())
+
+    def _read_gauges(self):
+        gauges = dict()
+        for name, fn in sorted(self.gauges.items()):
+            try:
+                gauges[name] = fn()
+            except Exception as e:
+                dbg('Failed to read gauge {}: {}', name, e)
+        return gauges
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)+'\n'
+
+    def to_prometheus(self):
+        # Returns all metrics in the Prometheus text exposition format
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            registered = sorted(self.histograms.items())
+        histograms = [(key, (h.buckets,)+h.state()[:3]) for key, h in registered]
+        typed = set()
+        def declare(name, kind):
+            if not name in typed:
+                typed.add(name)
+                lines.append('# TYPE {} {}'.format(name, kind))
+        for (name, labels), value in counters:
+            declare(PREFIX+name+'_total', 'counter')
+            lines.append('{} {}'.format(key_str(PREFIX+name+'_total', labels), value))
+        for (name, labels), (buckets, counts, count, total) in histograms:
+            name = PREFIX+name
+            declare(name, 'histogram')
+            cumulative = 0
+            for bound, n in zip(buckets, counts):
+                cumulative += n
+                le = '+Inf' if bound == math.inf else repr(bound)
+                lines.append('{} {}'.format(key_str(name+'_bucket', labels+(('le', le),)), cumulative))
+            lines.append('{} {}'.format(key_str(name+'_sum', labels), total))
+            lines.append('{} {}'.format(key_str(name+'_count', labels), count))
+        for name, value in self._read_gauges().items():
+            declare(PREFIX+name, 'gauge')
+            lines.append('{} {}'.format(PREFIX+name, value))
+        return '\n'.join(lines)+'\n'
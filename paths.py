@@ -0,0 +1,117 @@
+from utils import *
+
+import hashlib
+
+def inode(fid):
+    # Returns the inode number of a file ID, which is the same on every mount.
+    # They're 63-bit hashes, so collisions are practically impossible.
+    return int.from_bytes(hashlib.blake2b(fid.encode(), digest_size=8).digest(), 'little') >> 1 or 1
+
+class PathIndex():
+    # Bidirectional mapping between file IDs and the paths they're mounted at.
+    # Each node only stores its name and parent, so paths are computed by walking up
+    # the tree, and moving a directory moves its whole subtree along with it.
+    def __init__(self, root_id):
+        self.root_id = root_id
+        self.id_to_parent = {root_id: None}
+        self.id_to_name = {root_id: ''}
+        # maps directory IDs to {name: child ID} dicts
+        self.id_to_entries = {root_id: dict()}
+
+    def copy(self):
+        # Returns a copy of the index, which can be read while this one keeps changing
+        index = PathIndex(self.root_id)
+        index.id_to_parent = dict(self.id_to_parent)
+        index.id_to_name = dict(self.id_to_name)
+        index.id_to_entries = dict((fid, dict(entries)) for fid, entries in self.id_to_entries.items())
+        return index
+
+    def __contains__(self, fid):
+        return fid in self.id_to_parent
+
+    def _split(self, rpath):
+        # Returns the parent ID and the name for a path, or None if the parent isn't indexed
+        beg = rpath.rindex('/')
+        parent = self.lookup(rpath[:beg])
+        if parent is None or not parent in self.id_to_entries:
+            return None, None
+        return parent, rpath[beg+1:]
+
+    def lookup(self, rpath):
+        # Returns the ID of the file at a path, or None
+        fid = self.root_id
+        for name in rpath.split('/'):
+            if not name:
+                continue
+            entries = self.id_to_entries.get(fid)
+            if entries is None or not name in entries:
+                return None
+            fid = entries[name]
+        return fid
+
+    def path(self, fid):
+        # Returns the path of a file ID, or None
+        if not fid in self.id_to_parent:
+            return None
+        names = []
+        while fid != self.root_id:
+            names.append(self.id_to_name[fid])
+            fid = self.id_to_parent[fid]
+        return '/'+'/'.join(reversed(names)) if names else '/'
+
+    def entries(self, fid):
+        # Returns the (name, ID) pairs of the entries of a directory
+        return list(self.id_to_entries.get(fid, dict()).items())
+
+    def is_dir(self, fid):
+        return fid in self.id_to_entries
+
+    def parent(self, fid):
+        # Returns the ID of the directory a file is in, or None
+        return self.id_to_parent.get(fid)
+
+    def add(self, rpath, fid, is_dir=False):
+        # Index the file 'fid' at 'rpath'. Returns False if the parent isn't indexed.
+        parent, name = self._split(rpath)
+        if parent is None:
+            dbg('Failed to find parent of "{}" in the path index!', rpath)
+            return False
+        if fid in self.id_to_parent:
+            self._unlink(fid)
+        self.id_to_parent[fid] = parent
+        self.id_to_name[fid] = name
+        self.id_to_entries[parent][name] = fid
+        if is_dir and not fid in self.id_to_entries:
+            self.id_to_entries[fid] = dict()
+        return True
+
+    def move(self, fid, new_rpath):
+        # Move a file (and everything under it) to a new path
+        parent, name = self._split(new_rpath)
+        if parent is None:
+            dbg('Failed to find parent of "{}" in the path index!', new_rpath)
+            return False
+        self._unlink(fid)
+        self.id_to_parent[fid] = parent
+        self.id_to_name[fid] = name
+        self.id_to_entries[parent][name] = fid
+        return True
+
+    def remove(self, fid):
+        # Remove a file (and everything under it) from the index
+        if not fid in self.id_to_parent:
+            return
+        self._unlink(fid)
+        stack = [fid]
+        while len(stack) != 0:
+            cur = stack.pop()
+            stack.extend(self.id_to_entries.pop(cur, dict()).values())
+            del self.id_to_parent[cur]
+            del self.id_to_name[cur]
+
+    def _unlink(self, fid):
+        # Remove a file from its parent's entries
+        entries = self.id_to_entries.get(self.id_to_parent[fid])
+        name = self.id_to_name[fid]
+        if entries is not None and entries.get(name) == fid:
+            del entries[name]
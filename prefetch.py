@@ -0,0 +1,112 @@
+from utils import *
+from blocks import BLOCK_SIZE
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+PREFETCH_WORKERS = 2 # number of files (or read-ahead ranges) fetched concurrently in the background
+PREFETCH_SIZE = 4*(1 << 20) # only files up to this many bytes are prefetched
+PREFETCH_FILES = 32 # maximum number of files prefetched when a scan of a directory is detected
+SCAN_OPENS = 2 # files opened in name order after listing their directory that make a scan
+SCAN_WINDOW = 60 # seconds after a directory is listed that opens can start a scan
+
+class Prefetcher():
+    # Fetches file contents in the background ahead of when they're expected to be read.
+    # A directory is considered to be scanned (like by 'sha512sum dir/*', tar or rsync)
+    # when it's listed and then several of its files are opened in order of their names,
+    # after which its remaining files are worth fetching before they're opened.
+    # Sequential readers of large files get the blocks after what they've read so far.
+    def __init__(self, fetch, fetch_range, workers=PREFETCH_WORKERS):
+        # 'fetch' is called with a file ID, and 'fetch_range' with a file ID and a byte range
+        self.fetch = fetch
+        self.fetch_range = fetch_range
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=workers) if workers != 0 else None
+        # maps directory IDs to (time listed, name of the last file opened, files opened in order)
+        self.scans = dict()
+        self.pending = set() # IDs of files waiting to be prefetched, or being prefetched
+        self.ahead = dict() # maps IDs of files being read ahead to the end of the range to fetch
+
+    def __len__(self):
+        # Returns the number of files waiting to be prefetched or read ahead in
+        with self.lock:
+            return len(self.pending)+len(self.ahead)
+
+    def enabled(self):
+        return self.pool is not None
+
+    def listed(self, dir_id):
+        # Record that a directory was listed
+        with self.lock:
+            self.scans[dir_id] = (time.time(), None, 0)
+
+    def opened(self, dir_id, name):
+        # Record that the file 'name' in a directory was opened.
+        # Returns whether the directory is being scanned.
+        with self.lock:
+            scan = self.scans.get(dir_id)
+            if scan is None:
+                return False
+            listed_at, last_name, count = scan
+            if time.time()-listed_at > SCAN_WINDOW:
+                del self.scans[dir_id]
+                return False
+            count = count+1 if last_name is None or name > last_name else 1
+            self.scans[dir_id] = (listed_at, name, count)
+            return count >= SCAN_OPENS
+
+    def prefetch(self, fids):
+        # Fetch the contents of the files 'fids' in the background, in order
+        if self.pool is None:
+            return
+        with self.lock:
+            for fid in fids:
+                if not fid in self.pending:
+                    self.pending.add(fid)
+                    self.pool.submit(self._prefetch, fid)
+
+    def readahead(self, fid, start, end):
+        # Fetch the bytes [start, end) of a sparse local copy in the background
+        if self.pool is None or start >= end:
+            return
+        with self.lock:
+            if fid in self.ahead:
+                # already reading ahead, so just keep going further
+                self.ahead[fid] = max(self.ahead[fid], end)
+                return
+            self.ahead[fid] = end
+            self.pool.submit(self._read_ahead, fid, start)
+
+    def stop(self):
+        # Drop everything that hasn't started yet
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def _prefetch(self, fid):
+        try:
+            dbg('Prefetching file ID "{}"', fid)
+            self.fetch(fid)
+        except Exception as e:
+            dbg('Failed to prefetch file ID "{}": {}', fid, e)
+        finally:
+            with self.lock:
+                self.pending.discard(fid)
+
+    def _read_ahead(self, fid, start):
+        # Blocks are fetched one at a time, so a reader catching up
+        # only has to wait for the one being fetched
+        try:
+            while True:
+                with self.lock:
+                    end = self.ahead[fid]
+                    if start >= end:
+                        del self.ahead[fid]
+                        return
+                block_end = min((start//BLOCK_SIZE+1)*BLOCK_SIZE, end)
+                self.fetch_range(fid, start, block_end)
+                start = block_end
+        except Exception as e:
+            dbg('Failed to read ahead in file ID "{}": {}', fid, e)
+            with self.lock:
+                self.ahead.pop(fid, None)
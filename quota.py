@@ -0,0 +1,41 @@
+from utils import *
+
+from collections import OrderedDict
+
+class CacheQuota():
+    # Keeps track of how much disk space the local copies of file contents take up,
+    # and in which order they were last used, so the least recently used ones can be
+    # evicted when the cache grows past its quota. Limits of 0 mean no limit.
+    def __init__(self, max_bytes=0, max_files=0):
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        # maps file IDs to the number of bytes they take up, least recently used first
+        self.usage = OrderedDict()
+        self.total = 0
+
+    def __contains__(self, fid):
+        return fid in self.usage
+
+    def __len__(self):
+        return len(self.usage)
+
+    def touch(self, fid, size=None):
+        # Mark a file as the most recently used one, and update its size if given
+        if size is not None:
+            self.total += size-self.usage.get(fid, 0)
+            self.usage[fid] = size
+        elif not fid in self.usage:
+            return
+        self.usage.move_to_end(fid)
+
+    def remove(self, fid):
+        self.total -= self.usage.pop(fid, 0)
+
+    def over(self):
+        # Returns whether the cache is over its quota
+        return (self.max_bytes != 0 and self.total > self.max_bytes) or \
+               (self.max_files != 0 and len(self.usage) > self.max_files)
+
+    def lru(self):
+        # Returns the cached file IDs, least recently used first
+        return list(self.usage)
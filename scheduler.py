@@ -0,0 +1,155 @@
+from utils import *
+from metrics import Metrics
+
+from googleapiclient.errors import HttpError
+from contextlib import contextmanager
+import heapq
+import itertools
+import json
+import random
+import threading
+import time
+
+# Drive allows 12,000 requests per minute per user by default,
+# but projects can have lower quotas, so the rate adapts when throttled anyway
+RATE_LIMIT = 100 # requests per second sent to the Drive API (0 for no limit)
+BURST = 100 # requests that can be sent at once after being idle
+MIN_RATE = 1 # requests per second that throttling never slows the rate below
+RECOVERY = 100 # successful requests it takes to get back to the full rate after being throttled
+THROTTLE_RETRIES = 8 # attempts at a throttled request before giving up on it
+THROTTLE_DELAY = 1 # seconds before the first retry, doubled after every throttled attempt
+MAX_THROTTLE_DELAY = 64 # seconds that retries are delayed by at most
+
+# Requests of the interactive class are sent before any waiting background ones
+INTERACTIVE = 0 # requests that a filesystem operation is waiting on
+BACKGROUND = 1 # crawling, polling, revalidation and uploads
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BACKGROUND: 'background'}
+
+RATE_LIMIT_REASONS = ('userRateLimitExceeded', 'rateLimitExceeded')
+
+def is_throttled(e):
+    # Returns whether an exception means the request should be retried later
+    if not isinstance(e, HttpError):
+        return False
+    if e.resp.status == 429 or e.resp.status >= 500:
+        return True
+    if e.resp.status != 403:
+        return False
+    try:
+        errors = json.loads(e.content.decode('utf-8'))['error']['errors']
+        return any(error.get('reason') in RATE_LIMIT_REASONS for error in errors)
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return False
+
+class RequestScheduler():
+    # Paces the requests sent to the Drive API with a token bucket, and retries the
+    # ones that are throttled (rate limit errors, 429s and 5xx responses) with
+    # exponential backoff. Being throttled also halves the rate and holds back all
+    # other requests for the backoff delay, after which the rate recovers gradually.
+    # Waiting requests are sent in order of priority, and then in order of arrival.
+    def __init__(self, rate=RATE_LIMIT, burst=BURST, retries=THROTTLE_RETRIES, metrics=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.cond = threading.Condition()
+        self.tokens = burst
+        self.refilled_at = time.monotonic()
+        self.hold_until = 0 # nothing is sent before this (monotonic) time after being throttled
+        self.waiting = [] # heap of the (priority, arrival) of waiting requests
+        self.arrivals = itertools.count()
+        # The priority of the requests made by each thread
+        self.local = threading.local()
+        self.metrics = metrics or Metrics()
+        self.metrics.gauge('request_rate_limit', lambda: self.rate)
+        self.metrics.gauge('requests_waiting', lambda: len(self.waiting))
+
+    @contextmanager
+    def background(self):
+        # Send the requests made by the calling thread in this block as background requests
+        previous = self.priority()
+        self.local.priority = BACKGROUND
+        try:
+            yield
+        finally:
+            self.local.priority = previous
+
+    def in_background(self, fn):
+        # Returns a version of 'fn' that sends its requests as background requests,
+        # for the targets of background threads
+        def wrapper(*args, **kwargs):
+            with self.background():
+                return fn(*args, **kwargs)
+        return wrapper
+
+    def priority(self):
+        return getattr(self.local, 'priority', INTERACTIVE)
+
+    def call(self, fn, cost=1):
+        # Returns fn(), which sends 'cost' requests, once it's this thread's turn,
+        # retrying it if it's throttled
+        priority = self.priority()
+        delay = THROTTLE_DELAY
+        for attempt in range(1, self.retries+1):
+            self._acquire(priority, cost)
+            try:
+                result = fn()
+            except Exception as e:
+                if not is_throttled(e):
+                    raise
+                if attempt == self.retries:
+                    self.metrics.count('requests_failed')
+                    raise
+                retry_after = e.resp.get('retry-after', '')
+                wait = float(retry_after) if retry_after.isdigit() else delay*(1+random.random())
+                dbg('Request throttled with status {} (attempt {}), retrying in {:.1f}s', 
+                    e.resp.status, attempt, wait)
+                # the next attempt waits in line again, until the hold is over
+                self._throttled(wait)
+                delay = min(2*delay, MAX_THROTTLE_DELAY)
+                continue
+            self._succeeded()
+            return result
+
+    def _refill(self, now):
+        if self.rate != 0:
+            self.tokens = min(self.burst, self.tokens+(now-self.refilled_at)*self.rate)
+        self.refilled_at = now
+
+    def _acquire(self, priority, cost):
+        # Wait until this request is first in line, and there are tokens for it
+        with self.cond:
+            ticket = (priority, next(self.arrivals))
+            heapq.heappush(self.waiting, ticket)
+            start = time.monotonic()
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                delay = None
+                if self.waiting[0] == ticket:
+                    delay = self.hold_until-now
+                    if self.rate != 0:
+                        # requests costing more than the bucket holds go into debt
+                        delay = max(delay, (min(cost, self.burst)-self.tokens)/self.rate)
+                    if delay <= 0:
+                        break
+                self.cond.wait(delay)
+            heapq.heappop(self.waiting)
+            if self.rate != 0:
+                self.tokens -= cost
+            self.cond.notify_all()
+        self.metrics.count('requests', cost, priority=PRIORITY_NAMES[priority])
+        self.metrics.observe('request_wait_seconds', now-start, priority=PRIORITY_NAMES[priority])
+
+    def _throttled(self, wait):
+        self.metrics.count('requests_throttled')
+        with self.cond:
+            self.hold_until = max(self.hold_until, time.monotonic()+wait)
+            if self.rate != 0:
+                self.rate = max(MIN_RATE, self.rate/2)
+            self.cond.notify_all()
+
+    def _succeeded(self):
+        if self.rate != self.max_rate:
+            with self.cond:
+                self.rate = min(self.max_rate, self.rate+self.max_rate/RECOVERY)
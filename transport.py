@@ -0,0 +1,74 @@
+from utils import *
+
+import threading
+
+POOL_SIZE = 16 # maximum number of connections kept open to the Drive API
+TIMEOUT = 60 # seconds before a request without a response is given up on
+
+# Transports hand out the HTTP objects that API requests are executed on.
+# These look like httplib2.Http objects, since that's what googleapiclient expects.
+# The HTTP libraries are only imported once the first request is made, since they
+# take a while to import, and nothing is requested before the filesystem is mounted.
+
+class ThreadLocalTransport():
+    # Gives every thread its own httplib2 connection, since those can't be shared
+    # (so there's no pool to size)
+    def __init__(self, creds, pool_size=None):
+        self.creds = creds
+        self.local = threading.local()
+
+    def http(self):
+        # build_http() doesn't treat the 308s of resumable uploads as redirects
+        if not hasattr(self.local, 'http'):
+            from googleapiclient.http import build_http
+            import google_auth_httplib2
+            self.local.http = google_auth_httplib2.AuthorizedHttp(self.creds, http=build_http())
+        return self.local.http
+
+class PooledTransport():
+    # Shares a pool of keep-alive connections between all threads
+    def __init__(self, creds, pool_size=POOL_SIZE):
+        self.creds = creds
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self.pooled_http = None
+
+    def http(self):
+        if self.pooled_http is None:
+            with self.lock:
+                if self.pooled_http is None:
+                    self.pooled_http = PooledHttp(self._session())
+        return self.pooled_http
+
+    def _session(self):
+        from google.auth.transport.requests import AuthorizedSession
+        import requests
+        session = AuthorizedSession(self.creds)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+class PooledHttp():
+    # Adapts a requests session to the interface of httplib2.Http
+    def __init__(self, session):
+        import httplib2
+        self.session = session
+        self.response_class = httplib2.Response
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=None, connection_type=None):
+        # redirects are left to the caller, like the 308s of resumable uploads
+        response = self.session.request(method, uri, data=body, headers=headers,
+                                        allow_redirects=False, timeout=TIMEOUT)
+        info = dict((key.lower(), value) for key, value in response.headers.items())
+        # the contents have been decompressed already
+        info.pop('content-encoding', None)
+        info['status'] = str(response.status_code)
+        resp = self.response_class(info)
+        resp.reason = response.reason
+        return resp, response.content
+
+TRANSPORTS = {
+    'pooled': PooledTransport,
+    'thread-local': ThreadLocalTransport,
+}
@@ -0,0 +1,137 @@
+from utils import *
+
+import threading
+import random
+import time
+
+UPLOAD_WORKERS = 4 # number of files uploaded concurrently
+UPLOAD_RETRIES = 5 # attempts at uploading a file before putting it aside for a while
+RETRY_DELAY = 1 # seconds before the first retry, doubled after every failed attempt
+RETRY_LATER = 60 # seconds before a file that failed every attempt is tried again
+
+class UploadQueue():
+    # Uploads files in the background, so closing a file only waits for the local disk.
+    # Files are queued by ID, so a file that is written again while it's waiting
+    # is only uploaded once, and one that is written while it's uploading gets
+    # uploaded again afterwards (with its latest contents). Files that fail to upload 
+    # are never dropped, but tried again every RETRY_LATER seconds.
+    def __init__(self, upload, workers=UPLOAD_WORKERS, retries=UPLOAD_RETRIES):
+        # 'upload' is called with a file ID, and pushes the file's current contents
+        self.upload = upload
+        self.nworkers = workers
+        self.retries = retries
+        self.cond = threading.Condition()
+        self.queue = [] # IDs waiting to be uploaded, in order
+        self.queued = set()
+        self.active = set() # IDs being uploaded right now
+        self.failed = dict() # maps IDs whose uploads failed to when they're tried again
+        # (bytes uploaded, total bytes) of the active uploads that report their progress
+        self.progress = dict()
+        self.workers = []
+        self.stopped = False
+
+    def __contains__(self, fid):
+        # Returns whether a file is waiting to be uploaded (or retried), or being uploaded
+        with self.cond:
+            return fid in self.queued or fid in self.active or fid in self.failed
+
+    def __len__(self):
+        with self.cond:
+            return len(self.queue)+len(self.active)
+
+    def enqueue(self, fid):
+        with self.cond:
+            if fid in self.queued:
+                return
+            # (a file that failed is tried again right away, since it was written again)
+            self.failed.pop(fid, None)
+            dbg('Queueing upload of file ID "{}"', fid)
+            self.queue.append(fid)
+            self.queued.add(fid)
+            # Workers are started on demand, since FUSE forks after the constructor runs
+            if len(self.workers) == 0:
+                for _ in range(self.nworkers):
+                    worker = threading.Thread(target=self._work, daemon=True)
+                    worker.start()
+                    self.workers.append(worker)
+            # (all of them, since drain() waits on the same condition, 
+            # and could take a single notification meant for a worker)
+            self.cond.notify_all()
+
+    def report(self, fid, sent, total):
+        # Record the progress of an active upload
+        with self.cond:
+            if fid in self.active:
+                self.progress[fid] = (sent, total)
+
+    def sent(self):
+        # Returns the (bytes uploaded, total bytes) of the active uploads that report their progress
+        with self.cond:
+            return sum(p[0] for p in self.progress.values()), sum(p[1] for p in self.progress.values())
+
+    def drain(self):
+        # Wait for all queued uploads to finish (or fail)
+        with self.cond:
+            while len(self.queue) != 0 or len(self.active) != 0:
+                self.cond.wait()
+
+    def stop(self):
+        # Finish the queued uploads, and stop the workers
+        self.drain()
+        with self.cond:
+            if len(self.failed) != 0:
+                warn('Stopping with {} failed uploads'.format(len(self.failed)))
+            self.stopped = True
+            self.cond.notify_all()
+        for worker in self.workers:
+            worker.join()
+
+    def _next(self):
+        # Returns the next ID that isn't being uploaded already, or None when stopped
+        with self.cond:
+            while not self.stopped:
+                for i, fid in enumerate(self.queue):
+                    if not fid in self.active:
+                        del self.queue[i]
+                        self.queued.discard(fid)
+                        self.active.add(fid)
+                        return fid
+                # then the failed ones that are due to be tried again
+                now = time.time()
+                for fid, retry_at in self.failed.items():
+                    if retry_at <= now:
+                        del self.failed[fid]
+                        self.active.add(fid)
+                        return fid
+                if len(self.failed) != 0:
+                    self.cond.wait(min(self.failed.values())-now)
+                else:
+                    self.cond.wait()
+            return None
+
+    def _work(self):
+        while True:
+            fid = self._next()
+            if fid is None:
+                return
+            delay = RETRY_DELAY
+            failed = False
+            for attempt in range(1, self.retries+1):
+                try:
+                    self.upload(fid)
+                    break
+                except Exception as e:
+                    dbg('Upload of file ID "{}" failed (attempt {}): {}', fid, attempt, e)
+                    if attempt == self.retries:
+                        warn('Failed to upload file ID "{}", trying again in {} s: {}'.format(fid, RETRY_LATER, e))
+                        failed = True
+                    else:
+                        # back off, with some jitter so failed uploads don't retry in lockstep
+                        time.sleep(delay*(1+random.random()))
+                        delay *= 2
+            with self.cond:
+                self.active.discard(fid)
+                self.progress.pop(fid, None)
+                if failed and not fid in self.queued:
+                    self.failed[fid] = time.time()+RETRY_LATER
+                self.cond.notify_all()
@@ -9,14 +9,19 @@ RED = '\033[92m'
 BOLD = '\033[1m'
 END = '\033[0m'
 
-def dbg(msg, end='\n'):
+def dbg(msg, *args, end='\n'):
+    # The message is only formatted (with 'args') if it's going to be printed
     if DEBUG:
-        print(BLUE+BOLD+'[DBG] '+END+msg, end=end)
+        print(BLUE+BOLD+'[DBG] '+END+(msg.format(*args) if args else msg), end=end)
 
 def err(msg):
     print(RED+BOLD+'[ERR] '+END+msg)
     assert False
 
+def warn(msg):
+    # Like err, but for errors that can't be reported to the caller
+    print(RED+BOLD+'[ERR] '+END+msg)
+
 TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
 
 def local_to_utc(local_posix_time):
@@ -30,3 +35,7 @@ def tstr_to_posix(tstr):
         date = datetime.strptime(tstr, TIME_FORMAT)
     return calendar.timegm(date.timetuple())
 
+def posix_to_tstr(posix_time):
+    date = datetime.fromtimestamp(posix_time, tz=timezone.utc)
+    return date.strftime(TIME_FORMAT)
+
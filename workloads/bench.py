@@ -0,0 +1,343 @@
+#!/bin/python3
+# Benchmarks DriveFS against a local fake Drive server (see fakedrive.py), so results
+# are reproducible and don't need a Google account. The filesystem operations are
+# issued the way the kernel would issue them for the workloads, but straight to the
+# DriveFS object instead of through FUSE, so no mount (or root) is needed, and
+# every operation can be timed on its own. (libfuse still has to be installed, since 
+# fusepy loads it when drivefs.py imports it.)
+import argparse
+import atexit
+import hashlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+WORKLOADS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(WORKLOADS_DIR)
+# DriveFS keeps its configuration in ~/.drivefs/, which mustn't be the real one
+os.environ['HOME'] = tempfile.mkdtemp(prefix='drivefs-bench-')
+atexit.register(shutil.rmtree, os.environ['HOME'], ignore_errors=True)
+sys.path.append(REPO_DIR)
+os.chdir(REPO_DIR)
+
+from fakedrive import FakeDrive, FOLDER_MTYPE, make_tree
+try:
+    import drivefs
+except EnvironmentError as e:
+    sys.exit('Failed to load DriveFS, is libfuse installed? ({})'.format(e))
+
+READ_SIZE = 128*1024 # bytes per read or write, like the kernel's requests
+SHEET_MTYPE = 'application/vnd.google-apps.spreadsheet'
+PERCENTILES = (50, 90, 99)
+
+class Client():
+    # Issues filesystem operations on a DriveFS, and records how long each one takes
+    def __init__(self, fs):
+        self.fs = fs
+        self.latencies = dict() # maps operation names to lists of seconds
+
+    def __call__(self, op, *args):
+        start = time.perf_counter()
+        try:
+            return self.fs(op, *args)
+        finally:
+            self.latencies.setdefault(op, []).append(time.perf_counter()-start)
+
+    def exists(self, path):
+        try:
+            self('getattr', path)
+            return True
+        except OSError:
+            return False
+
+    def isdir(self, path):
+        return self('getattr', path)['st_mode'] & 0o170000 == 0o040000
+
+    def listdir(self, path):
+        fh = self('opendir', path)
+        try:
+            # entries are names, or (name, attributes, offset) tuples
+            names = [entry if isinstance(entry, str) else entry[0] for entry in self('readdir', path, fh)]
+        finally:
+            self('releasedir', path, fh)
+        return [name for name in names if not name in ('.', '..')]
+
+    def walk(self, path):
+        # Like 'tree' or 'du': list every directory, and stat everything in it.
+        # Returns the total size of the files.
+        total = 0
+        for name in self.listdir(path):
+            child = path.rstrip('/')+'/'+name
+            attrs = self('getattr', child)
+            if attrs['st_mode'] & 0o170000 == 0o040000:
+                total += self.walk(child)
+            else:
+                total += attrs['st_size']
+        return total
+
+    def cat(self, path):
+        # Like 'sha512sum': read a whole file sequentially. Returns its hash.
+        self('getattr', path)
+        fh = self('open', path, os.O_RDONLY)
+        digest = hashlib.sha512()
+        offset = 0
+        while True:
+            data = self('read', path, READ_SIZE, offset, fh)
+            if not data:
+                break
+            digest.update(data)
+            offset += len(data)
+        self('flush', path, fh)
+        self('release', path, fh)
+        return digest.hexdigest()
+
+    def write(self, path, data):
+        # Like a shell redirection: create (or truncate) a file and write it
+        if self.exists(path):
+            fh = self('open', path, os.O_WRONLY)
+            self('truncate', path, 0, fh)
+        else:
+            fh = self('create', path, 0o644)
+        for offset in range(0, len(data), READ_SIZE):
+            self('write', path, data[offset:offset+READ_SIZE], offset, fh)
+        self('flush', path, fh)
+        self('release', path, fh)
+
+    def rmtree(self, path):
+        # Like 'rm -rf'
+        for name in self.listdir(path):
+            child = path+'/'+name
+            if self.isdir(child):
+                self.rmtree(child)
+            else:
+                self('unlink', child)
+        self('rmdir', path)
+
+''' Scenarios '''
+# Each scenario has a function that fills the fake drive before mounting,
+# and one that runs its workload on the mounted filesystem for a number of iterations.
+
+def setup_eval(store, args, rng):
+    # Something like the drive the shell workloads were written for
+    store.add('Getting started.pdf', store.root, data=rng.randbytes(1 << 20))
+    store.add('lab2.zip', store.root, data=rng.randbytes(3 << 20))
+    folder = store.add('folder2', store.root, FOLDER_MTYPE)
+    store.add('vim-test.txt', folder, data=b'vim test\n'*100)
+    make_tree(store, store.root, 5, 2, 3, 1024, rng, prefix='misc-')
+
+def run_tree(client, args, rng):
+    # tree.sh
+    for _ in range(args.iterations):
+        client.walk('/')
+
+def run_fs_ops(client, args, rng):
+    # fs-ops.sh
+    for _ in range(args.iterations):
+        client.walk('/')
+        client('mkdir', '/dir-test', 0o755)
+        client.write('/random.txt', rng.randbytes(64*64))
+        client('rename', '/random.txt', '/dir-test/random.txt')
+        client.rmtree('/dir-test')
+
+def run_reads(client, args, rng):
+    # reads.sh
+    for _ in range(args.iterations):
+        for name in client.listdir('/'):
+            if name.startswith('Getting started'):
+                client.cat('/'+name)
+        client.cat('/lab2.zip')
+        client.cat('/folder2/vim-test.txt')
+
+def run_writes(client, args, rng):
+    # writes.sh
+    for _ in range(args.iterations):
+        client.write('/test.txt', b'This is a test write!\n')
+        client.cat('/test.txt')
+        client('unlink', '/test.txt')
+        client.write('/test.txt', ''.join('{}\n'.format(i) for i in range(1, 1000001)).encode())
+        client.cat('/test.txt')
+        client('unlink', '/test.txt')
+
+def setup_large_file(store, args, rng):
+    store.add('large.bin', store.root, data=rng.randbytes(args.large_size))
+
+def run_large_file(client, args, rng):
+    # read a large file sequentially, and then write one (which is uploaded in chunks)
+    for i in range(args.iterations):
+        client.cat('/large.bin')
+        client.write('/large-{}.bin'.format(i), rng.randbytes(args.large_size))
+
+def setup_small_files(store, args, rng):
+    folder = store.add('small', store.root, FOLDER_MTYPE)
+    make_tree(store, folder, args.files, 0, 0, args.size, rng)
+
+def run_small_files(client, args, rng):
+    # like 'sha512sum small/*', and then writing as many files
+    for i in range(args.iterations):
+        for name in sorted(client.listdir('/small')):
+            client.cat('/small/'+name)
+        client('mkdir', '/written-{}'.format(i), 0o755)
+        for j in range(args.files):
+            client.write('/written-{}/file{:04d}.bin'.format(i, j), rng.randbytes(args.size))
+
+def setup_deep_tree(store, args, rng):
+    make_tree(store, store.root, 2, args.depth, args.fanout, args.size, rng)
+
+def run_deep_tree(client, args, rng):
+    # walk the whole tree, and stat and read a path at the bottom of it
+    deepest = '/'+'/'.join(['dir00']*args.depth)+'/file0000.bin'
+    for _ in range(args.iterations):
+        client.walk('/')
+        client.cat(deepest)
+
+def setup_documents(store, args, rng):
+    folder = store.add('documents', store.root, FOLDER_MTYPE)
+    for i in range(args.files):
+        store.add('sheet{:04d}'.format(i), folder, SHEET_MTYPE, data=rng.randbytes(args.size))
+
+def run_documents(client, args, rng):
+    # list a folder full of Sheets, and read a few of them, which are the only ones exported
+    for _ in range(args.iterations):
+        client.walk('/documents')
+        for name in sorted(client.listdir('/documents'))[:3]:
+            client.cat('/documents/'+name)
+
+SCENARIOS = {
+    'tree': (setup_eval, run_tree),
+    'fs-ops': (setup_eval, run_fs_ops),
+    'reads': (setup_eval, run_reads),
+    'writes': (setup_eval, run_writes),
+    'large-file': (setup_large_file, run_large_file),
+    'small-files': (setup_small_files, run_small_files),
+    'deep-tree': (setup_deep_tree, run_deep_tree),
+    'documents': (setup_documents, run_documents),
+}
+
+''' Running and reporting '''
+
+def percentile(values, p):
+    # Nearest-rank percentile of a sorted list
+    return values[max(0, min(len(values)-1, (len(values)*p+99)//100-1))]
+
+def summarize(latencies):
+    summary = dict()
+    for op, values in latencies.items():
+        values = sorted(values)
+        summary[op] = dict(count=len(values), max=values[-1], total=sum(values),
+                           **{'p{}'.format(p): percentile(values, p) for p in PERCENTILES})
+    return summary
+
+def run_scenario(name, args):
+    setup, run = SCENARIOS[name]
+    rng = random.Random(args.seed)
+    server = FakeDrive(latency=args.latency, bandwidth=args.bandwidth, quota=args.quota,
+                       error_rate=args.error_rate, seed=args.seed)
+    setup(server.store, args, rng)
+    server.start()
+    cache_dir = tempfile.mkdtemp(prefix='drivefs-cache-')
+    try:
+        # Mounting is timed as two operations of its own: 'mount' until FUSE could take 
+        # over, and 'ready' until the cache has been built in the background
+        start = time.perf_counter()
+        fs = drivefs.DriveFS(fresh=True, cache_dir=cache_dir, endpoint=server.url(),
+                             poll_interval=args.poll_interval, **args.options)
+        fs('init', '/')
+        client = Client(fs)
+        client.latencies['mount'] = [time.perf_counter()-start]
+        fs.started.wait()
+        client.latencies['ready'] = [time.perf_counter()-start]
+        run(client, args, rng)
+        # unmounting waits for the uploads
+        client('destroy', '/')
+        requests = dict(server.store.calls)
+        metrics = fs.metrics.snapshot()
+    finally:
+        server.stop()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    return dict(latencies=summarize(client.latencies), requests=requests, metrics=metrics)
+
+def report(name, result):
+    print('== {} =='.format(name))
+    print('{:<10} {:>7} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+          'operation', 'count', *['p{} ms'.format(p) for p in PERCENTILES], 'max ms', 'total ms'))
+    for op, stats in sorted(result['latencies'].items()):
+        print('{:<10} {:>7} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.1f}'.format(op, stats['count'],
+              *[stats['p{}'.format(p)]*1000 for p in PERCENTILES], stats['max']*1000, stats['total']*1000))
+    print('{:<40} {:>7}'.format('API requests', sum(result['requests'].values())))
+    for request, count in sorted(result['requests'].items()):
+        print('  {:<38} {:>7}'.format(request, count))
+    print()
+
+def compare(results, baseline, tolerance):
+    # Returns the regressions of 'results' against 'baseline': more API requests,
+    # or operations whose 90th percentile latency got slower by more than 'tolerance'
+    regressions = []
+    for name, result in results.items():
+        if not name in baseline:
+            continue
+        old = baseline[name]
+        for request, count in result['requests'].items():
+            if count > old['requests'].get(request, 0):
+                regressions.append('{}: {} requests of "{}" (was {})'.format(
+                                   name, count, request, old['requests'].get(request, 0)))
+        for op, stats in result['latencies'].items():
+            if op in old['latencies'] and stats['p90'] > old['latencies'][op]['p90']*(1+tolerance):
+                regressions.append('{}: p90 of {} is {:.2f} ms (was {:.2f} ms)'.format(
+                                   name, op, stats['p90']*1000, old['latencies'][op]['p90']*1000))
+    return regressions
+
+def parse_options(options):
+    # Parses 'name=value' DriveFS constructor arguments
+    parsed = dict()
+    for option in options:
+        key, value = option.split('=', 1)
+        try:
+            parsed[key] = json.loads(value)
+        except ValueError:
+            parsed[key] = value
+    return parsed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark DriveFS against a local fake Drive server.')
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS),
+                        help='scenarios to run (all by default): '+', '.join(SCENARIOS))
+    parser.add_argument('--iterations', type=int, default=4, help='times each workload is repeated')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the server takes per request')
+    parser.add_argument('--bandwidth', type=float, default=50e6, help='bytes per second of transfers (0 for no limit)')
+    parser.add_argument('--quota', type=int, default=0, help='requests per second before rate limit errors (0 for no limit)')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests answered with rate limit errors')
+    parser.add_argument('--files', type=int, default=100, help='number of files in small-files')
+    parser.add_argument('--size', type=int, default=16*1024, help='bytes per file in small-files and deep-tree')
+    parser.add_argument('--large-size', type=int, default=32 << 20, help='bytes per file in large-file')
+    parser.add_argument('--depth', type=int, default=5, help='levels of folders in deep-tree')
+    parser.add_argument('--fanout', type=int, default=2, help='subfolders per folder in deep-tree')
+    parser.add_argument('--poll-interval', type=float, default=5, help='passed on to DriveFS')
+    parser.add_argument('--option', action='append', default=[], metavar='NAME=VALUE',
+                        help='other DriveFS constructor argument, e.g. --option prefetch_workers=0')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the generated contents and errors')
+    parser.add_argument('--save', metavar='FILE', help='save the results as JSON')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare with results saved before, and fail if anything regressed')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='fraction by which a p90 latency can grow before it counts as a regression')
+    args = parser.parse_args()
+    args.options = parse_options(args.option)
+    results = dict()
+    for name in args.scenarios:
+        if not name in SCENARIOS:
+            parser.error('Unknown scenario "{}"'.format(name))
+        results[name] = run_scenario(name, args)
+        report(name, results[name])
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('Regression in '+regression)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,373 @@
+#!/bin/python3
+# A fake Drive v3 server, implementing just enough of the API for DriveFS:
+# files (get, list, create, update, delete, media and export downloads), revision
+# downloads, simple,
+# multipart and resumable uploads, batch requests and the changes feed.
+# It keeps everything in memory, and can be slowed down to look like the real thing.
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import email
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+FOLDER_MTYPE = 'application/vnd.google-apps.folder'
+WORKSPACE_PREFIX = 'application/vnd.google-apps.' # of the mimetypes of Workspace documents
+JSON = 'application/json'
+
+def now():
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime())+'.{:03d}Z'.format(int(time.time()*1000)%1000)
+
+def error(code, message, reason=None):
+    body = {'error': {'code': code, 'message': message}}
+    if reason is not None:
+        body['error']['errors'] = [{'reason': reason, 'domain': 'usageLimits', 'message': message}]
+    return code, body, JSON, None
+
+class Store():
+    # The contents of the fake drive, and counts of the requests made to it
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.files = dict() # maps IDs to metadata
+        self.data = dict() # maps IDs to contents
+        self.changes = [] # (file ID, removed) for every change, the page tokens index this
+        self.sessions = dict() # maps resumable upload session IDs to (file ID, bytes so far)
+        self.revisions = dict() # maps (file ID, revision ID) to the contents of every revision
+        self.calls = dict() # maps 'METHOD /path' (with file IDs replaced by X) to request counts
+        self.root = self.add('My Drive', None, FOLDER_MTYPE)
+
+    def add(self, name, parent, mimetype='application/octet-stream', data=b'', trashed=False):
+        # Add a file (or folder), and return its ID
+        fid = uuid.uuid4().hex[:16]
+        self.files[fid] = {'id': fid, 'name': name, 'mimeType': mimetype, 'modifiedTime': now(),
+                           'viewedByMeTime': now(), 'parents': [parent] if parent else [],
+                           'trashed': trashed}
+        self.data[fid] = data
+        self.changed(fid)
+        return fid
+
+    def changed(self, fid, removed=False):
+        item = self.files.get(fid)
+        # like Drive, Workspace documents (and folders) have no size or checksum
+        if item is not None and not item['mimeType'].startswith(WORKSPACE_PREFIX):
+            item['size'] = str(len(self.data[fid]))
+            md5 = hashlib.md5(self.data[fid]).hexdigest()
+            # new contents make a new revision (Drive keeps the old ones for a while)
+            if item.get('md5Checksum') != md5 or not 'headRevisionId' in item:
+                item['headRevisionId'] = uuid.uuid4().hex[:16]
+                self.revisions[(fid, item['headRevisionId'])] = self.data[fid]
+            item['md5Checksum'] = md5
+        self.changes.append((fid, removed))
+
+    def count(self, key):
+        self.calls[key] = self.calls.get(key, 0)+1
+
+def request_key(method, path):
+    # Returns the key a request is counted under, with the IDs in its path (of files, 
+    # revisions and upload sessions) replaced by X
+    return method+' '+re.sub(r'/(files|revisions|sessions)/[^/]+', r'/\1/X', path)
+
+def media_response(contents, headers):
+    # Returns the response to a media download, of the Range requested if any
+    if 'Range' in headers:
+        start, end = headers['Range'].split('=')[1].split('-')
+        start, end = int(start), min(int(end or len(contents)-1), len(contents)-1)
+        return 206, contents[start:end+1], 'application/octet-stream', \
+               {'Content-Range': 'bytes {}-{}/{}'.format(start, end, len(contents))}
+    return 200, contents, 'application/octet-stream', None
+
+def matches(store, query, item):
+    # Returns whether an item matches a files.list query (of the kinds DriveFS makes)
+    for clause in re.split(r'\s+and\s+', query) if query else []:
+        m = re.match(r"""^['"](.+)['"] in parents$""", clause.strip())
+        if m:
+            parent = store.root if m.group(1) == 'root' else m.group(1)
+            if not parent in item['parents']:
+                return False
+            continue
+        m = re.match(r"""^name = '(.*)'$""", clause.strip())
+        if m:
+            if item['name'] != m.group(1).replace("\\'", "'").replace('\\\\', '\\'):
+                return False
+            continue
+        m = re.match(r'^trashed = (true|false)$', clause.strip())
+        if m:
+            if item['trashed'] != (m.group(1) == 'true'):
+                return False
+            continue
+        raise ValueError('Unsupported query "{}"'.format(clause))
+    return True
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Responses are written in pieces (status line, headers, body), which Nagle's algorithm
+    # would hold back until the client's delayed ACK, adding ~40 ms to every request
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def do_PATCH(self):
+        self.route('PATCH')
+
+    def do_PUT(self):
+        self.route('PUT')
+
+    def do_DELETE(self):
+        self.route('DELETE')
+
+    def send(self, code, body, ctype, headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or dict()).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def route(self, method):
+        server = self.server
+        store = server.store
+        url = urlparse(self.path)
+        query = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+        data = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        media = query.get('alt') == 'media'
+        with store.lock:
+            store.count(request_key(method, url.path)+(' media' if media else ''))
+        # every request takes at least the latency, and transfers take as long as the bandwidth allows
+        delay = server.latency
+        if server.bandwidth != 0:
+            delay += len(data)/server.bandwidth
+        response = server.throttle()
+        if response is None:
+            with store.lock:
+                response = self.respond(store, method, url.path, query, data, self.headers)
+        code, body, ctype, headers = response
+        if server.bandwidth != 0 and (media or url.path.endswith('/export')):
+            delay += len(body)/server.bandwidth
+        time.sleep(delay)
+        self.send(code, body, ctype, headers)
+
+    def respond(self, store, method, path, query, data, headers):
+        # Returns (status, body, content type, headers) for a request
+        m = re.match(r'^/drive/v3/files/([^/]+)$', path)
+        if m:
+            fid = store.root if m.group(1) == 'root' else m.group(1)
+            if not fid in store.files:
+                return error(404, 'File not found: {}'.format(fid))
+            if method == 'GET' and query.get('alt') == 'media':
+                return media_response(store.data[fid], headers)
+            if method == 'GET':
+                return 200, store.files[fid], JSON, None
+            if method == 'DELETE':
+                del store.files[fid]
+                store.changed(fid, removed=True)
+                return 204, b'', JSON, None
+            if method == 'PATCH':
+                item = store.files[fid]
+                body = json.loads(data or b'{}')
+                item.update(body)
+                if 'addParents' in query:
+                    item['parents'] = [p for p in item['parents'] if p != query.get('removeParents')]
+                    item['parents'].append(query['addParents'])
+                if not 'modifiedTime' in body:
+                    item['modifiedTime'] = now()
+                store.changed(fid)
+                return 200, item, JSON, None
+        m = re.match(r'^/drive/v3/files/([^/]+)/revisions/([^/]+)$', path)
+        if m and method == 'GET' and query.get('alt') == 'media':
+            if not (m.group(1), m.group(2)) in store.revisions:
+                return error(404, 'Revision not found: {}'.format(m.group(2)))
+            return media_response(store.revisions[(m.group(1), m.group(2))], headers)
+        m = re.match(r'^/drive/v3/files/([^/]+)/export$', path)
+        if m:
+            if not m.group(1) in store.files:
+                return error(404, 'File not found: {}'.format(m.group(1)))
+            return 200, store.data[m.group(1)], query.get('mimeType'), None
+        if path == '/drive/v3/files' and method == 'GET':
+            items = [item for item in store.files.values()
+                     if item['id'] != store.root and matches(store, query.get('q'), item)]
+            items.sort(key=lambda item: item['id'])
+            start = int(query.get('pageToken', 0))
+            size = int(query.get('pageSize', 100))
+            results = {'files': items[start:start+size]}
+            if start+size < len(items):
+                results['nextPageToken'] = str(start+size)
+            return 200, results, JSON, None
+        if path == '/drive/v3/files' and method == 'POST':
+            body = json.loads(data or b'{}')
+            fid = store.add(body['name'], body.get('parents', [store.root])[0],
+                            body.get('mimeType', 'application/octet-stream'), trashed=body.get('trashed', False))
+            return 200, store.files[fid], JSON, None
+        m = re.match(r'^/upload/drive/v3/files/([^/]+)$', path)
+        if m:
+            fid = m.group(1)
+            if not fid in store.files:
+                return error(404, 'File not found: {}'.format(fid))
+            upload_type = query.get('uploadType')
+            if upload_type == 'resumable':
+                sid = uuid.uuid4().hex
+                store.sessions[sid] = (fid, bytearray())
+                location = 'http://{}:{}/upload/sessions/{}'.format(*self.server.server_address, sid)
+                return 200, b'', JSON, {'Location': location}
+            if upload_type == 'multipart':
+                message = email.message_from_bytes(b'Content-Type: '+headers['Content-Type'].encode()+b'\r\n\r\n'+data)
+                metadata, media = message.get_payload()
+                store.files[fid].update(json.loads(metadata.get_payload()))
+                store.data[fid] = media.get_payload(decode=True)
+            else:
+                store.data[fid] = data
+            store.files[fid]['modifiedTime'] = now()
+            store.changed(fid)
+            return 200, store.files[fid], JSON, None
+        m = re.match(r'^/upload/sessions/([^/]+)$', path)
+        if m:
+            if not m.group(1) in store.sessions:
+                return error(404, 'No such upload session')
+            fid, received = store.sessions[m.group(1)]
+            sent, total = headers.get('Content-Range', 'bytes */*').split(' ')[1].split('/')
+            if sent != '*':
+                start = int(sent.split('-')[0])
+                if start != len(received):
+                    return error(400, 'Expected bytes from {}'.format(len(received)))
+                received += data
+            if total != '*' and len(received) == int(total):
+                del store.sessions[m.group(1)]
+                store.data[fid] = bytes(received)
+                store.files[fid]['modifiedTime'] = now()
+                store.changed(fid)
+                return 200, store.files[fid], JSON, None
+            return 308, b'', JSON, {'Range': 'bytes=0-{}'.format(len(received)-1)} if received else None
+        if path == '/batch/drive/v3' and method == 'POST':
+            return self.handle_batch(store, headers, data)
+        if path == '/drive/v3/changes/startPageToken':
+            return 200, {'startPageToken': str(len(store.changes))}, JSON, None
+        if path == '/drive/v3/changes':
+            start = int(query['pageToken'])
+            size = int(query.get('pageSize', 100))
+            changes = []
+            for fid, removed in store.changes[start:start+size]:
+                change = {'fileId': fid, 'removed': removed or not fid in store.files}
+                if not change['removed']:
+                    change['file'] = store.files[fid]
+                changes.append(change)
+            results = {'changes': changes}
+            if start+size < len(store.changes):
+                results['nextPageToken'] = str(start+size)
+            else:
+                results['newStartPageToken'] = str(len(store.changes))
+            return 200, results, JSON, None
+        return error(404, 'No route for {} {}'.format(method, path))
+
+    def handle_batch(self, store, headers, data):
+        # Each part of a batch request is a request of its own, and counted as one
+        message = email.message_from_bytes(b'Content-Type: '+headers['Content-Type'].encode()+b'\r\n\r\n'+data)
+        boundary = 'batch_'+uuid.uuid4().hex
+        out = b''
+        for part in message.get_payload():
+            request = part.get_payload()
+            if isinstance(request, list):
+                request = request[0].as_string()
+            head, _, body = request.replace('\r\n', '\n').partition('\n\n')
+            lines = head.split('\n')
+            method, uri, _ = lines[0].split(' ')
+            sub_headers = dict(line.split(': ', 1) for line in lines[1:] if ': ' in line)
+            url = urlparse(uri)
+            query = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+            store.count(request_key(method, url.path)+' (batched)')
+            code, body, ctype, _ = self.server.throttle() or \
+                                   self.respond(store, method, url.path, query, body.encode(), sub_headers)
+            if isinstance(body, (dict, list)):
+                body = json.dumps(body).encode()
+            out += ('--{}\r\nContent-Type: application/http\r\nContent-ID: <response-{}>\r\n\r\n'
+                    'HTTP/1.1 {} X\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n').format(
+                    boundary, part['Content-ID'].strip('<>'), code, ctype, len(body)).encode()+body+b'\r\n'
+        out += '--{}--\r\n'.format(boundary).encode()
+        return 200, out, 'multipart/mixed; boundary='+boundary, None
+
+class FakeDrive(ThreadingHTTPServer):
+    # Serves a Store on a local port, adding 'latency' seconds to every request and
+    # transferring contents at 'bandwidth' bytes per second (0 for no limit).
+    # Requests beyond 'quota' per second (0 for no limit) and a random 'error_rate'
+    # fraction of the rest are answered with rate limit errors.
+    daemon_threads = True
+
+    def __init__(self, store=None, port=0, latency=0, bandwidth=0, quota=0, error_rate=0, seed=0):
+        super().__init__(('127.0.0.1', port), Handler)
+        self.store = store or Store()
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.quota = quota
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.quota_lock = threading.Lock()
+        self.window = (0, 0) # (second, requests in it)
+        self.thread = None
+
+    def url(self):
+        return 'http://{}:{}/'.format(*self.server_address)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def throttle(self):
+        # Returns a rate limit error response if this request is over the quota, or None
+        with self.quota_lock:
+            second = int(time.monotonic())
+            count = self.window[1]+1 if self.window[0] == second else 1
+            self.window = (second, count)
+            over = (self.quota != 0 and count > self.quota) or self.random.random() < self.error_rate
+        if not over:
+            return None
+        with self.store.lock:
+            self.store.count('throttled')
+        return error(403, 'User Rate Limit Exceeded', 'userRateLimitExceeded')
+
+def make_tree(store, parent, files, depth, fanout, size, rng, prefix=''):
+    # Add a synthetic tree under 'parent': 'files' files of 'size' bytes in every folder,
+    # and 'fanout' subfolders in every folder down to 'depth' levels
+    for i in range(files):
+        store.add('{}file{:04d}.bin'.format(prefix, i), parent, data=rng.randbytes(size))
+    if depth == 0:
+        return
+    for i in range(fanout):
+        folder = store.add('{}dir{:02d}'.format(prefix, i), parent, FOLDER_MTYPE)
+        make_tree(store, folder, files, depth-1, fanout, size, rng, prefix)
+
+if __name__ == '__main__':
+    # Serve a synthetic tree, to mount with "drivefs.py --endpoint"
+    import argparse
+    parser = argparse.ArgumentParser(description='Serve a fake Google Drive for testing DriveFS.')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every request')
+    parser.add_argument('--bandwidth', type=float, default=0, help='bytes per second of transfers (0 for no limit)')
+    parser.add_argument('--quota', type=int, default=0, help='requests per second before rate limit errors (0 for no limit)')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests answered with rate limit errors')
+    parser.add_argument('--files', type=int, default=10, help='files per folder')
+    parser.add_argument('--depth', type=int, default=2, help='levels of folders')
+    parser.add_argument('--fanout', type=int, default=3, help='subfolders per folder')
+    parser.add_argument('--size', type=int, default=4096, help='bytes per file')
+    args = parser.parse_args()
+    server = FakeDrive(port=args.port, latency=args.latency, bandwidth=args.bandwidth,
+                       quota=args.quota, error_rate=args.error_rate)
+    make_tree(server.store, server.store.root, args.files, args.depth, args.fanout, args.size, random.Random(0))
+    print('Serving {} files at {}'.format(len(server.store.files), server.url()))
+    server.serve_forever()